@@ -8,6 +8,10 @@ from src.handlers.converters import handle_photo, handle_document
 from src.handlers.document_converter import handle_document_conversion, handle_conversion_choice
 from src.handlers.video_converter import handle_video
 from src.handlers.callbacks import handle_text
+from src.workers import shutdown_workers
+from src.spool import SPOOL
+from src.office import OFFICE_POOL
+from src.updates import PerUserUpdateProcessor
 
 # Enable logging
 logging.basicConfig(
@@ -17,8 +21,10 @@ logger = logging.getLogger(__name__)
 
 def main() -> None:
     """Start the bot."""
-    # Create the Application
-    application = Application.builder().token(TOKEN).build()
+    # Create the Application; updates of different users are processed concurrently
+    # so that long conversions do not hold up other users (or the "Отмена" button),
+    # while each user's own updates keep their order
+    application = Application.builder().token(TOKEN).concurrent_updates(PerUserUpdateProcessor()).build()
 
     # Command handlers
     application.add_handler(CommandHandler("start", start))
@@ -65,9 +71,14 @@ def main() -> None:
     # Text handler
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
 
+    # Remove work files left over by a previous run
+    SPOOL.sweep()
+
     # Run the bot until the user presses Ctrl-C
     logger.info("Bot started")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
+    shutdown_workers()
+    OFFICE_POOL.shutdown()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -7,6 +8,75 @@ load_dotenv()
 # Bot token
 TOKEN = os.getenv("TELEGRAM_TOKEN")
 
+# FFmpeg settings
+FFMPEG_BIN = os.getenv("FFMPEG_BIN", r"C:\ffmpeg\bin")
+FFMPEG_MAX_JOBS = int(os.getenv("FFMPEG_MAX_JOBS", "2"))  # Одновременных процессов FFmpeg
+FFMPEG_TIMEOUT = int(os.getenv("FFMPEG_TIMEOUT", "900"))  # Секунд на одну конвертацию
+FFPROBE_TIMEOUT = int(os.getenv("FFPROBE_TIMEOUT", "30"))
+PROBE_CACHE_SIZE = int(os.getenv("PROBE_CACHE_SIZE", "256"))  # Файлов, чей анализ FFprobe хранится в памяти
+
+# Segment-parallel transcoding of long videos (0 disables it)
+SEGMENT_MIN_DURATION = int(os.getenv("SEGMENT_MIN_DURATION", "300"))  # Секунд, от которых видео режется на части
+SEGMENT_COUNT = int(os.getenv("SEGMENT_COUNT", str(os.cpu_count() or 2)))  # Частей, кодируемых параллельно
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", "5"))  # Секунд между правками сообщения о прогрессе
+
+# Fit-to-size video encoding for the Bot API upload limit
+UPLOAD_LIMIT_BYTES = int(os.getenv("UPLOAD_LIMIT_BYTES", str(50 * 1024 * 1024)))
+VIDEO_TWO_PASS = os.getenv("VIDEO_TWO_PASS", "false").lower() == "true"  # Двухпроходное кодирование
+MIN_VIDEO_BITRATE = int(os.getenv("MIN_VIDEO_BITRATE", "150000"))  # Бит/с, ниже - отказ
+PIPE_MAX_BYTES = int(os.getenv("PIPE_MAX_BYTES", str(8 * 1024 * 1024)))  # Видео меньше - через stdin/stdout, 0 - выключено
+
+# Spool directory for uploads and conversion work files (on disk in the system temp dir by default)
+SPOOL_DOWNLOADS = os.getenv("SPOOL_DOWNLOADS", "false").lower() == "true"  # Загрузки сразу в spool, а не в память
+SPOOL_DIR = os.getenv("SPOOL_DIR", os.path.join(tempfile.gettempdir(), "file-converter-bot"))
+SPOOL_QUOTA_BYTES = int(os.getenv("SPOOL_QUOTA_BYTES", str(1024 * 1024 * 1024)))  # Не больше свободного места, 0 - только оно
+
+# Pending uploads (files waiting for the user to pick a format)
+PENDING_TTL = int(os.getenv("PENDING_TTL", "1800"))  # Секунд с последнего обращения
+PENDING_MAX_BYTES = int(os.getenv("PENDING_MAX_BYTES", str(512 * 1024 * 1024)))  # Общий лимит памяти
+PENDING_SPILL_BYTES = int(os.getenv("PENDING_SPILL_BYTES", str(20 * 1024 * 1024)))  # Крупнее - на диск
+
+# Conversion result cache (Telegram file_id of already sent results)
+DATA_DIR = os.getenv("DATA_DIR", "data")  # Постоянные данные бота (в отличие от spool переживают перезапуск)
+RESULT_CACHE_PATH = os.getenv("RESULT_CACHE_PATH", os.path.join(DATA_DIR, "result_cache.sqlite3"))  # Пустое значение - без кэша
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "100000"))
+RESULT_CACHE_MAX_AGE = int(os.getenv("RESULT_CACHE_MAX_AGE", str(30 * 24 * 3600)))  # Секунд
+
+# Worker processes for CPU-bound conversions (Pillow encoding and others)
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", str(os.cpu_count() or 2)))
+
+# Image size limits offered to users, in KB
+IMAGE_SIZE_LIMITS = {'До 500 КБ': 500, 'До 1 МБ': 1024, 'До 2 МБ': 2048}
+# Resize presets: the longer side of the result, in pixels
+IMAGE_RESIZE_PRESETS = {'1280 px': 1280, '1920 px': 1920, '4096 px': 4096}
+
+# Video encoder presets: x264 -preset/-crf, MPEG-4 (AVI) -q:v, audio bitrate, encoder threads (0 - авто)
+VIDEO_PRESETS = {
+    'fast': {'x264_preset': 'veryfast', 'crf': 23, 'mpeg4_quality': 5, 'audio_bitrate': 128000, 'threads': 0},
+    'balanced': {'x264_preset': 'medium', 'crf': 23, 'mpeg4_quality': 4, 'audio_bitrate': 128000, 'threads': 0},
+    'small': {'x264_preset': 'slow', 'crf': 28, 'mpeg4_quality': 8, 'audio_bitrate': 96000, 'threads': 0}
+}
+VIDEO_PRESET_LABELS = {'fast': 'Быстрый', 'balanced': 'Сбалансированный', 'small': 'Компактный'}
+VIDEO_PRESET = os.getenv("VIDEO_PRESET", "balanced")  # Пресет по умолчанию
+VIDEO_PRESET_OVERRIDE = os.getenv("VIDEO_PRESET_OVERRIDE", "")  # Пресет для всех пользователей (при нагрузке)
+VIDEO_THREADS = int(os.getenv("VIDEO_THREADS", "0"))  # Потоков кодировщика на процесс, 0 - как в пресете
+if VIDEO_THREADS:
+    for _preset in VIDEO_PRESETS.values():
+        _preset['threads'] = VIDEO_THREADS
+
+# Headless LibreOffice for DOC/DOCX -> PDF
+OFFICE_BIN = os.getenv("OFFICE_BIN", "soffice")
+OFFICE_WORKERS = int(os.getenv("OFFICE_WORKERS", "2"))  # Постоянно запущенных процессов, 0 - запуск на каждый файл
+OFFICE_PORT = int(os.getenv("OFFICE_PORT", "2002"))  # UNO-порт первого процесса, остальные - следующие по порядку
+OFFICE_TIMEOUT = int(os.getenv("OFFICE_TIMEOUT", "120"))  # Секунд на один документ
+
+# Native TXT -> PDF rendering
+PDF_FONT_PATH = os.getenv("PDF_FONT_PATH", "")  # Моноширинный TTF с кириллицей, пусто - поиск среди установленных
+PDF_SHARD_PAGES = int(os.getenv("PDF_SHARD_PAGES", "20"))  # Страниц PDF на одну задачу извлечения текста
+PDF_DOCX_PROCESSES = int(os.getenv("PDF_DOCX_PROCESSES", "0"))  # Процессов pdf2docx, 0 - по числу ядер, 1 - один
+PDF_DOCX_PARALLEL_PAGES = int(os.getenv("PDF_DOCX_PARALLEL_PAGES", "20"))  # Страниц, от которых PDF -> DOCX идет в несколько процессов
+PPTX_MAX_SLIDES = int(os.getenv("PPTX_MAX_SLIDES", "200"))  # Слайдов в презентации из DOCX, остальное отбрасывается
+
 # Supported formats
 SUPPORTED_IMAGE_FORMATS = ['JPG', 'PNG', 'WEBP']
 SUPPORTED_DOCUMENT_FORMATS = ['PDF', 'DOCX', 'DOC', 'TXT']
@@ -18,7 +88,10 @@ DEFAULT_SETTINGS = {
     'default_format': 'PNG',
     'maintain_exif': True,
     'optimize_size': True,
-    'video_metadata': None  # Может быть 'iPhone', 'Android' или 'CapCut'
+    'image_max_kb': None,  # Лимит размера изображения в КБ, None - без ограничения
+    'image_max_side': None,  # Наибольшая сторона изображения в пикселях, None - исходное разрешение
+    'video_metadata': None,  # Может быть 'iPhone', 'Android' или 'CapCut'
+    'video_preset': VIDEO_PRESET  # 'fast', 'balanced' или 'small'
 }
 
 # Metadata presets
@@ -93,6 +166,11 @@ HELP_MESSAGE = """
 • Формат по умолчанию
 • Сохранение EXIF данных
 • Оптимизация размера
+• Сжатие до нужного размера (500 КБ, 1 МБ, 2 МБ)
+• Уменьшение разрешения (1280, 1920, 4096 px)
+
+⚙️ Настройки видео:
+• Пресет: быстрый, сбалансированный или компактный
 
 📄 Поддержка документов:
 • Конвертация PDF в DOCX и TXT
@@ -135,6 +213,8 @@ FORMATS_MESSAGE = """
   - CapCut (как после редактирования)
 """
 
+UPLOAD_EXPIRED_MESSAGE = "⏳ Файл устарел и был удален. Пожалуйста, отправьте его снова."
+
 SETTINGS_MESSAGE = """
 ⚙️ Настройки конвертации:
 
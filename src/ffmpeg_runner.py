@@ -0,0 +1,230 @@
+"""
+Asynchronous FFmpeg/FFprobe runner.
+"""
+import os
+import re
+import shutil
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Hashable, List, Optional
+from src.config import FFMPEG_BIN, FFMPEG_MAX_JOBS, FFMPEG_TIMEOUT, FFPROBE_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+READ_CHUNK_SIZE = 64 * 1024
+STDERR_TAIL_LINES = 40
+_LINE_SPLIT = re.compile(rb'[\r\n]')
+
+def _find_executable(name: str) -> str:
+    """Locate an FFmpeg tool in FFMPEG_BIN, falling back to PATH."""
+    for candidate in (os.path.join(FFMPEG_BIN, f"{name}.exe"), os.path.join(FFMPEG_BIN, name)):
+        if os.path.isfile(candidate):
+            return candidate
+    return shutil.which(name) or name
+
+FFMPEG_EXE = _find_executable('ffmpeg')
+FFPROBE_EXE = _find_executable('ffprobe')
+
+class FFmpegError(RuntimeError):
+    """FFmpeg or FFprobe failed."""
+
+class FFmpegTimeout(FFmpegError):
+    """FFmpeg did not finish in time."""
+
+class FFmpegCancelled(FFmpegError):
+    """FFmpeg job was cancelled by the user."""
+
+@dataclass
+class ProcessResult:
+    """Outcome of a finished FFmpeg/FFprobe process."""
+    returncode: int
+    stdout: bytes
+    stderr: str
+
+@dataclass(eq=False)
+class FFmpegJob:
+    """Concurrency slot shared by the processes of one conversion."""
+    owner: Optional[Hashable] = None
+    cancel_event: asyncio.Event = field(default_factory=asyncio.Event)
+
+_semaphore: Optional[asyncio.Semaphore] = None
+_jobs = {}
+
+def _get_semaphore() -> asyncio.Semaphore:
+    """Get the global FFmpeg concurrency limiter."""
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(FFMPEG_MAX_JOBS)
+    return _semaphore
+
+def cancel_jobs(owner: Hashable) -> int:
+    """Cancel all queued and running FFmpeg jobs of the owner."""
+    jobs = _jobs.get(owner, set())
+    for job in jobs:
+        job.cancel_event.set()
+    if jobs:
+        logger.info(f"Cancelling {len(jobs)} FFmpeg job(s) of {owner}")
+    return len(jobs)
+
+async def _acquire(semaphore: asyncio.Semaphore, job: FFmpegJob) -> None:
+    """Wait for a free slot unless the job gets cancelled first."""
+    acquire = asyncio.ensure_future(semaphore.acquire())
+    cancelled = asyncio.ensure_future(job.cancel_event.wait())
+    acquired = False
+    try:
+        await asyncio.wait({acquire, cancelled}, return_when=asyncio.FIRST_COMPLETED)
+        acquired = not job.cancel_event.is_set()
+    finally:
+        cancelled.cancel()
+        if not acquire.done():
+            acquire.cancel()
+            await asyncio.wait({acquire})
+        if not acquired and not acquire.cancelled():
+            semaphore.release()
+    if not acquired:
+        raise FFmpegCancelled("Конвертация отменена")
+
+@asynccontextmanager
+async def ffmpeg_job(owner: Optional[Hashable] = None):
+    """Reserve one FFmpeg slot and register it for cancellation."""
+    job = FFmpegJob(owner=owner)
+    _jobs.setdefault(owner, set()).add(job)
+    try:
+        semaphore = _get_semaphore()
+        await _acquire(semaphore, job)
+        try:
+            yield job
+        finally:
+            semaphore.release()
+    finally:
+        jobs = _jobs.get(owner)
+        if jobs is not None:
+            jobs.discard(job)
+            if not jobs:
+                del _jobs[owner]
+
+async def _read_lines(stream: asyncio.StreamReader, on_line: Callable[[str], None]) -> None:
+    """Drain a pipe incrementally, splitting output on CR/LF."""
+    buffer = b''
+    while True:
+        chunk = await stream.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        buffer += chunk
+        *lines, buffer = _LINE_SPLIT.split(buffer)
+        if len(buffer) > READ_CHUNK_SIZE:
+            lines.append(buffer)
+            buffer = b''
+        for line in lines:
+            if line:
+                on_line(line.decode('utf-8', errors='replace'))
+    if buffer:
+        on_line(buffer.decode('utf-8', errors='replace'))
+
+async def _write_all(stream: asyncio.StreamWriter, data: bytes) -> None:
+    """Feed data to a pipe and close it."""
+    try:
+        stream.write(data)
+        await stream.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # Процесс перестал читать (FFprobe или ошибка): итог покажет код возврата
+        pass
+    finally:
+        stream.close()
+
+async def _read_all(stream: asyncio.StreamReader, output: bytearray) -> None:
+    """Drain a pipe into a buffer."""
+    while True:
+        chunk = await stream.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        output.extend(chunk)
+
+def _kill(process: asyncio.subprocess.Process) -> None:
+    """Kill the process if it is still running."""
+    if process.returncode is None:
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+
+async def _execute(command: List[str], job: FFmpegJob, timeout: Optional[float],
+                   on_stdout_line: Optional[Callable[[str], None]] = None,
+                   input_data: Optional[bytes] = None) -> ProcessResult:
+    """Run the command, enforcing the timeout and the job's cancel event.
+
+    input_data, if given, is written to the process's stdin (pipe:0).
+    """
+    logger.info(f"Running: {' '.join(command)}")
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.DEVNULL if input_data is None else asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+    except FileNotFoundError:
+        raise FFmpegError(f"FFmpeg не найден: {command[0]}")
+
+    stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+    stdout = bytearray()
+    pipes = [asyncio.ensure_future(_read_lines(process.stderr, stderr_tail.append))]
+    if on_stdout_line:
+        pipes.append(asyncio.ensure_future(_read_lines(process.stdout, on_stdout_line)))
+    else:
+        pipes.append(asyncio.ensure_future(_read_all(process.stdout, stdout)))
+    if input_data is not None:
+        pipes.append(asyncio.ensure_future(_write_all(process.stdin, input_data)))
+    waiter = asyncio.ensure_future(process.wait())
+    cancelled = asyncio.ensure_future(job.cancel_event.wait())
+    try:
+        done, _ = await asyncio.wait(
+            {waiter, cancelled}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+        )
+        if waiter not in done:
+            _kill(process)
+            await process.wait()
+            if cancelled in done:
+                raise FFmpegCancelled("Конвертация отменена")
+            raise FFmpegTimeout(f"Превышено время конвертации ({timeout} с)")
+        await asyncio.gather(*pipes)
+    finally:
+        cancelled.cancel()
+        _kill(process)
+        for pipe in pipes:
+            pipe.cancel()
+
+    return ProcessResult(process.returncode, bytes(stdout), '\n'.join(stderr_tail))
+
+async def run_ffmpeg(args: List[str], owner: Optional[Hashable] = None,
+                     timeout: Optional[float] = FFMPEG_TIMEOUT,
+                     on_stdout_line: Optional[Callable[[str], None]] = None,
+                     job: Optional[FFmpegJob] = None,
+                     input_data: Optional[bytes] = None) -> ProcessResult:
+    """Run FFmpeg with the given arguments without blocking the event loop.
+
+    Without an explicit job a new slot is reserved for the owner; passing a job
+    lets several processes of one conversion share its slot and cancellation.
+    input_data is fed to the 'pipe:0' input; without on_stdout_line the
+    'pipe:1' output is returned in the result's stdout.
+    """
+    command = [FFMPEG_EXE, '-hide_banner', '-nostdin', '-y', *args]
+    if job is None:
+        async with ffmpeg_job(owner) as job:
+            result = await _execute(command, job, timeout, on_stdout_line, input_data)
+    else:
+        result = await _execute(command, job, timeout, on_stdout_line, input_data)
+
+    if result.returncode != 0:
+        logger.error(f"FFmpeg error: {result.stderr}")
+        raise FFmpegError(f"Ошибка при конвертации: {result.stderr}")
+    return result
+
+async def run_ffprobe(args: List[str], timeout: Optional[float] = FFPROBE_TIMEOUT,
+                      input_data: Optional[bytes] = None) -> ProcessResult:
+    """Run FFprobe with the given arguments; probes are not throttled."""
+    command = [FFPROBE_EXE, '-hide_banner', *args]
+    return await _execute(command, FFmpegJob(), timeout, input_data=input_data)
@@ -1,16 +1,22 @@
 from telegram import Update
 from telegram.ext import ContextTypes
-from src.handlers.converters import convert_image
-from src.handlers.document_converter import convert_document
-from src.handlers.video_converter import convert_video
+from src.handlers.converters import convert_image, convert_image_formats
+from src.handlers.document_converter import PAGE_RANGE_PATTERN, convert_document, has_pending_pdf, set_page_range
+from src.handlers.video_converter import convert_video, convert_video_formats
 from src.keyboards import (
     get_main_keyboard, get_quality_keyboard, 
     get_format_default_keyboard, get_boolean_keyboard,
     get_settings_keyboard, get_format_keyboard,
-    get_metadata_keyboard, get_video_format_keyboard
+    get_metadata_keyboard, get_video_format_keyboard,
+    get_video_preset_keyboard, get_resize_keyboard
 )
 from src.handlers.commands import help_command, formats_command, settings_command
-from src.config import IMAGES
+from src.config import (
+    IMAGES, VIDEO_PRESET_LABELS, VIDEO_PRESET_OVERRIDE,
+    SUPPORTED_IMAGE_FORMATS, SUPPORTED_VIDEO_FORMATS, IMAGE_SIZE_LIMITS, IMAGE_RESIZE_PRESETS
+)
+from src.ffmpeg_runner import cancel_jobs
+from src.pending import PENDING_UPLOADS
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle text messages."""
@@ -46,7 +52,15 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             text=f"{IMAGES['settings']}\nВыберите качество изображения:\n\n"
                  "• Высокое - минимальное сжатие\n"
                  "• Среднее - оптимальное сжатие\n"
-                 "• Низкое - максимальное сжатие",
+                 "• Низкое - максимальное сжатие\n\n"
+                 "Или ограничьте размер: качество и, если нужно, масштаб подберутся автоматически",
+            reply_markup=keyboard
+        )
+    elif text == 'Разрешение':
+        keyboard = get_resize_keyboard()
+        await update.message.reply_text(
+            text=f"{IMAGES['settings']}\nВыберите наибольшую сторону изображения:\n\n"
+                 "Большие фото будут уменьшены при конвертации, меньшие останутся как есть.",
             reply_markup=keyboard
         )
     elif text == 'Формат по умолчанию':
@@ -70,6 +84,15 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
                  "При включенной оптимизации файлы будут меньше, но конвертация займет больше времени.",
             reply_markup=keyboard
         )
+    elif text == 'Пресет видео':
+        keyboard = get_video_preset_keyboard()
+        await update.message.reply_text(
+            text=f"{IMAGES['settings']}\nВыберите пресет кодирования видео:\n\n"
+                 "• Быстрый - быстрее всего, файл больше\n"
+                 "• Сбалансированный - разумный размер и скорость\n"
+                 "• Компактный - меньший размер, но дольше и ниже качество",
+            reply_markup=keyboard
+        )
     elif text == 'Конвертировать':
         keyboard = get_format_keyboard()
         await update.message.reply_text(
@@ -86,12 +109,10 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             reply_markup=keyboard
         )
     elif text == 'Отмена':
-        if 'current_image' in context.user_data:
-            del context.user_data['current_image']
-        if 'current_document' in context.user_data:
-            del context.user_data['current_document']
-        if 'current_video' in context.user_data:
-            del context.user_data['current_video']
+        # Останавливаем запущенные процессы FFmpeg этого пользователя
+        cancel_jobs(update.effective_user.id)
+        PENDING_UPLOADS.discard(update.effective_user.id)
+        context.user_data.pop('current_file', None)
         keyboard = get_main_keyboard()
         await update.message.reply_text(
             text=f"{IMAGES['error']} Операция отменена. Чем могу помочь?",
@@ -122,8 +143,20 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         await convert_video(update, context, text, metadata_type)
         if 'metadata_type' in context.user_data:
             del context.user_data['metadata_type']
+    elif text == 'Во все форматы':
+        # Один раз декодируем исходник и отправляем все форматы одной группой
+        metadata_type = context.user_data.get('metadata_type')
+        if PENDING_UPLOADS.has(update.effective_user.id, 'video'):
+            await convert_video_formats(update, context, SUPPORTED_VIDEO_FORMATS, metadata_type)
+        else:
+            await convert_image_formats(update, context, SUPPORTED_IMAGE_FORMATS, metadata_type)
+        if 'metadata_type' in context.user_data:
+            del context.user_data['metadata_type']
     elif text in ['PDF', 'DOCX', 'TXT']:
         await convert_document(update, context, text)
+    elif PAGE_RANGE_PATTERN.match(text) and has_pending_pdf(update.effective_user.id):
+        # Число или диапазон - это страницы, только если ждет PDF
+        await set_page_range(update, context)
     elif text in ['Высокое', 'Среднее', 'Низкое']:
         quality = {'Высокое': 90, 'Среднее': 80, 'Низкое': 60}
         context.user_data['settings']['image_quality'] = quality[text]
@@ -132,9 +165,32 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             text=f"{IMAGES['success']} Качество изображения установлено на: {text}",
             reply_markup=keyboard
         )
+    elif text in IMAGE_SIZE_LIMITS or text == 'Без ограничения размера':
+        context.user_data['settings']['image_max_kb'] = IMAGE_SIZE_LIMITS.get(text)
+        keyboard = get_settings_keyboard()
+        await update.message.reply_text(
+            text=f"{IMAGES['success']} Размер изображения: {text.lower()}",
+            reply_markup=keyboard
+        )
+    elif text in IMAGE_RESIZE_PRESETS or text == 'Исходное разрешение':
+        context.user_data['settings']['image_max_side'] = IMAGE_RESIZE_PRESETS.get(text)
+        keyboard = get_settings_keyboard()
+        await update.message.reply_text(
+            text=f"{IMAGES['success']} Разрешение изображения: {text if text in IMAGE_RESIZE_PRESETS else 'исходное'}",
+            reply_markup=keyboard
+        )
+    elif text in VIDEO_PRESET_LABELS.values():
+        presets = {label: name for name, label in VIDEO_PRESET_LABELS.items()}
+        context.user_data['settings']['video_preset'] = presets[text]
+        keyboard = get_settings_keyboard()
+        note = "\n\n⚠️ Сейчас для всех действует пресет администратора" if VIDEO_PRESET_OVERRIDE else ""
+        await update.message.reply_text(
+            text=f"{IMAGES['success']} Пресет видео установлен: {text}{note}",
+            reply_markup=keyboard
+        )
     elif text in ['iPhone', 'Android', 'CapCut']:
         context.user_data['metadata_type'] = text
-        if 'current_video' in context.user_data:
+        if PENDING_UPLOADS.has(update.effective_user.id, 'video'):
             keyboard = get_video_format_keyboard()
         else:
             keyboard = get_format_keyboard()
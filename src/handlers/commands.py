@@ -2,7 +2,7 @@ from telegram import Update, ReplyKeyboardMarkup
 from telegram.ext import ContextTypes
 from src.config import (
     WELCOME_MESSAGE, HELP_MESSAGE, FORMATS_MESSAGE, 
-    SETTINGS_MESSAGE, IMAGES, DEFAULT_SETTINGS
+    SETTINGS_MESSAGE, IMAGES, DEFAULT_SETTINGS, VIDEO_PRESET, VIDEO_PRESET_LABELS, IMAGE_SIZE_LIMITS
 )
 from src.keyboards import get_main_keyboard, get_settings_keyboard
 
@@ -15,11 +15,17 @@ def get_user_settings(context: ContextTypes.DEFAULT_TYPE) -> dict:
 def format_settings(settings: dict) -> str:
     """Format settings for display."""
     quality_text = {90: "Высокое", 80: "Среднее", 60: "Низкое"}
+    size_text = {max_kb: label for label, max_kb in IMAGE_SIZE_LIMITS.items()}
+    max_kb = settings.get('image_max_kb')
+    max_side = settings.get('image_max_side')
     return (
         f"• Качество: {quality_text.get(settings['image_quality'], 'Среднее')}\n"
+        f"• Размер изображения: {size_text.get(max_kb, f'До {max_kb} КБ') if max_kb else 'Без ограничения'}\n"
+        f"• Разрешение: {f'До {max_side} px' if max_side else 'Исходное'}\n"
         f"• Формат по умолчанию: {settings['default_format']}\n"
         f"• Сохранение EXIF: {'Включено' if settings['maintain_exif'] else 'Выключено'}\n"
-        f"• Оптимизация размера: {'Включена' if settings['optimize_size'] else 'Выключена'}"
+        f"• Оптимизация размера: {'Включена' if settings['optimize_size'] else 'Выключена'}\n"
+        f"• Пресет видео: {VIDEO_PRESET_LABELS.get(settings.get('video_preset', VIDEO_PRESET), 'Сбалансированный')}"
     )
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
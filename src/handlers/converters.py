@@ -1,14 +1,26 @@
 import io
+import asyncio
 import logging
 import piexif
-from PIL import Image
 from telegram import Update
 from telegram.ext import ContextTypes
 from src.keyboards import get_format_keyboard, get_metadata_keyboard
-from src.config import IMAGES, DEFAULT_SETTINGS
+from src.config import IMAGES, DEFAULT_SETTINGS, UPLOAD_EXPIRED_MESSAGE
+from src.spool import download_upload
+from src.workers import run_in_process
+from src.imaging import ImageSizeError, decode_image, encode_decoded, encode_image, fit_image, retag_jpeg
+from src.pending import PENDING_UPLOADS
+from src.result_cache import ResultCache, lookup_result, reply_cached, remember_result, reply_document_group
 
 logger = logging.getLogger(__name__)
 
+# Image MIME types accepted as documents and their formats on the keyboard
+IMAGE_MIME_FORMATS = {
+    'image/jpeg': 'JPG',
+    'image/png': 'PNG',
+    'image/webp': 'WEBP'
+}
+
 DEVICE_METADATA = {
     'iPhone': {
         'make': 'Apple',
@@ -28,13 +40,9 @@ def get_user_settings(context: ContextTypes.DEFAULT_TYPE) -> dict:
         context.user_data['settings'] = DEFAULT_SETTINGS.copy()
     return context.user_data['settings']
 
-def create_exif_dict(metadata_type: str) -> bytes:
-    """Create EXIF dictionary with device metadata."""
-    if metadata_type not in DEVICE_METADATA:
-        return None
-        
-    exif_dict = piexif.load(piexif.dump({}))  # Create empty EXIF dict
-    device = DEVICE_METADATA[metadata_type]
+def build_device_exif(device: dict) -> bytes:
+    """Serialize device information into an EXIF block."""
+    exif_dict = {'0th': {}, 'Exif': {}, 'GPS': {}, '1st': {}, 'thumbnail': None}
     
     # Add device information
     exif_dict['0th'][piexif.ImageIFD.Make] = device['make'].encode('utf-8')
@@ -43,6 +51,13 @@ def create_exif_dict(metadata_type: str) -> bytes:
     
     return piexif.dump(exif_dict)
 
+# EXIF блоки не меняются, собираем их один раз
+DEVICE_EXIF = {name: build_device_exif(device) for name, device in DEVICE_METADATA.items()}
+
+def create_exif_dict(metadata_type: str) -> bytes:
+    """Get the EXIF block with device metadata."""
+    return DEVICE_EXIF.get(metadata_type)
+
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle photo messages."""
     try:
@@ -50,11 +65,15 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         photo = update.message.photo[-1]
         
         # Download the photo
-        photo_file = await context.bot.get_file(photo.file_id)
-        photo_bytes = await photo_file.download_as_bytearray()
+        upload = await download_upload(context.bot, photo.file_id, 'photo.jpg')
         
-        # Store the photo data in context
-        context.user_data['current_image'] = photo_bytes
+        # Store the photo until the user picks a format
+        PENDING_UPLOADS.put(update.effective_user.id, 'image', {
+            **upload,
+            'name': 'photo.jpg',
+            'format': 'JPG',
+            'file_unique_id': photo.file_unique_id
+        })
         
         # Ask user what they want to do
         keyboard = get_metadata_keyboard()
@@ -78,13 +97,17 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         document = update.message.document
         mime_type = document.mime_type
         
-        if mime_type in ['image/jpeg', 'image/png', 'image/webp']:
+        if mime_type in IMAGE_MIME_FORMATS:
             # Download the document
-            doc_file = await context.bot.get_file(document.file_id)
-            doc_bytes = await doc_file.download_as_bytearray()
+            upload = await download_upload(context.bot, document.file_id, document.file_name)
             
-            # Store the document data in context
-            context.user_data['current_image'] = doc_bytes
+            # Store the image until the user picks a format
+            PENDING_UPLOADS.put(update.effective_user.id, 'image', {
+                **upload,
+                'name': document.file_name,
+                'format': IMAGE_MIME_FORMATS[mime_type],
+                'file_unique_id': document.file_unique_id
+            })
             
             # Ask user what they want to do
             keyboard = get_metadata_keyboard()
@@ -109,91 +132,184 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 async def convert_image(update: Update, context: ContextTypes.DEFAULT_TYPE, target_format: str, metadata_type: str = None) -> None:
     """Convert image to target format and optionally add metadata."""
     try:
-        if 'current_image' not in context.user_data:
-            await update.message.reply_text(
-                text=f"{IMAGES['error']} Пожалуйста, сначала отправьте изображение для конвертации."
-            )
+        user_id = update.effective_user.id
+        upload = PENDING_UPLOADS.get(user_id, 'image')
+        if upload is None:
+            if PENDING_UPLOADS.expired(user_id, 'image'):
+                text = f"{IMAGES['error']} {UPLOAD_EXPIRED_MESSAGE}"
+            else:
+                text = f"{IMAGES['error']} Пожалуйста, сначала отправьте изображение для конвертации."
+            await update.message.reply_text(text=text)
             return
             
-        # Get image data and settings
-        image_bytes = context.user_data['current_image']
+        # Get settings
         settings = get_user_settings(context)
         
-        # Open image
-        img = Image.open(io.BytesIO(image_bytes))
-        
-        # Convert and save
-        output = io.BytesIO()
-        
-        # Convert format name to proper format
-        format_mapping = {
-            'JPG': 'JPEG',
-            'PNG': 'PNG',
-            'WEBP': 'WEBP'
-        }
-        
-        save_format = format_mapping.get(target_format.upper())
-        if not save_format:
-            raise ValueError(f"Неподдерживаемый формат: {target_format}")
-        
-        # Save with appropriate settings for each format
-        save_kwargs = {}
-        
-        if save_format == 'JPEG':
-            # Remove alpha channel if present
-            if img.mode in ('RGBA', 'LA'):
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                background.paste(img, mask=img.split()[-1])
-                img = background
-            save_kwargs.update({
-                'quality': settings['image_quality'],
-                'optimize': settings['optimize_size']
-            })
-            
-            # Add metadata if requested
-            if metadata_type:
-                exif_bytes = create_exif_dict(metadata_type)
-                if exif_bytes:
-                    save_kwargs['exif'] = exif_bytes
-                
-        elif save_format == 'PNG':
-            save_kwargs.update({
-                'optimize': settings['optimize_size']
-            })
-            
-        elif save_format == 'WEBP':
-            save_kwargs.update({
-                'quality': settings['image_quality'],
-                'method': 6 if settings['optimize_size'] else 4
-            })
-            
-        # Save the image
-        img.save(output, format=save_format, **save_kwargs)
-        output.seek(0)
-        
-        # Send the converted file
-        await update.message.reply_document(
-            document=output,
-            filename=f"converted_image.{target_format.lower()}",
-            caption=f"Вот ваше изображение в формате {target_format.upper()}! ✨"
+        caption = f"Вот ваше изображение в формате {target_format.upper()}! ✨"
+        max_kb = settings.get('image_max_kb')
+        max_side = settings.get('image_max_side')
+        cache_key = ResultCache.make_key(
+            upload.get('file_unique_id'), target_format, metadata_type,
+            quality=settings['image_quality'], optimize=settings['optimize_size'], exif=settings['maintain_exif'],
+            max_kb=max_kb, max_side=max_side
         )
         
+        lossless = False
+        fit_result = None
+        if not await reply_cached(update.message, cache_key, caption):
+            # Decoding and encoding run in the worker pool, off the event loop
+            source = upload['path'] if 'path' in upload else upload['bytes']
+            exif_bytes = create_exif_dict(metadata_type) if metadata_type else None
+            data = None
+            if exif_bytes and target_format.upper() == 'JPG' and not max_side:
+                # JPEG -> JPG с новыми метаданными: меняем только EXIF, без перекодирования
+                data = await run_in_process(retag_jpeg, source, exif_bytes, settings['maintain_exif'])
+                if data is not None and max_kb and len(data) > max_kb * 1024:
+                    data = None
+                lossless = data is not None
+            if data is None and max_kb:
+                # Качество и масштаб подбираются под лимит бинарным поиском, пробные кодирования идут
+                # одно за другим: каждое следующее зависит от размера предыдущего, а параллельные
+                # попытки заняли бы весь пул ради одного файла
+                data, *fit_result = await run_in_process(
+                    fit_image, source, target_format, max_kb * 1024,
+                    settings['image_quality'], settings['optimize_size'], exif_bytes, settings['maintain_exif'],
+                    max_side
+                )
+            if data is None:
+                data = await run_in_process(
+                    encode_image, source, target_format,
+                    settings['image_quality'], settings['optimize_size'], exif_bytes, settings['maintain_exif'],
+                    max_side
+                )
+            output = io.BytesIO(data)
+            
+            # Send the converted file
+            sent = await update.message.reply_document(
+                document=output,
+                filename=f"converted_image.{target_format.lower()}",
+                caption=caption
+            )
+            await remember_result(cache_key, sent)
+        
         # Send success message with settings used
         quality_text = {90: "высокое", 80: "среднее", 60: "низкое"}
+        if lossless:
+            quality_info = "исходное (без перекодирования)"
+        elif fit_result:
+            fit_quality, fit_scale, encodes = fit_result
+            quality_info = f"{fit_quality} (подобрано под {max_kb} КБ за {encodes} кодирований)"
+            if fit_scale < 1:
+                quality_info += f"\n• Масштаб: {fit_scale:.0%}"
+        else:
+            quality_info = quality_text.get(settings['image_quality'], 'среднее')
         settings_text = (
             f"{IMAGES['success']} 📊 Использованные настройки:\n"
-            f"• Качество: {quality_text.get(settings['image_quality'], 'среднее')}\n"
+            f"• Качество: {quality_info}\n"
             f"• Оптимизация: {'включена' if settings['optimize_size'] else 'выключена'}\n"
-            f"• Метаданные: {metadata_type if metadata_type else 'без изменений'}"
+            f"• Разрешение: {f'до {max_side} px' if max_side else 'исходное'}\n"
+            f"• Метаданные: {metadata_type if metadata_type else 'без изменений'}\n"
+            f"• Исходный EXIF: {'сохранен' if settings['maintain_exif'] else 'удален'}"
         )
         
         await update.message.reply_text(text=settings_text)
         
         # Clear the stored image
-        del context.user_data['current_image']
+        PENDING_UPLOADS.discard(user_id, 'image')
         
+    except ImageSizeError as e:
+        await update.message.reply_text(
+            text=f"{IMAGES['error']} {str(e)}"
+        )
     except Exception as e:
         logger.error(f"Error converting image: {str(e)}")
+        await update.message.reply_text(
+            text=f"{IMAGES['error']} Извините, произошла ошибка при конвертации. Пожалуйста, попробуйте снова."
+        )
+
+async def convert_image_formats(update: Update, context: ContextTypes.DEFAULT_TYPE, target_formats: list,
+                                metadata_type: str = None) -> None:
+    """Convert image to several formats at once and send them as a media group."""
+    try:
+        user_id = update.effective_user.id
+        upload = PENDING_UPLOADS.get(user_id, 'image')
+        if upload is None:
+            if PENDING_UPLOADS.expired(user_id, 'image'):
+                text = f"{IMAGES['error']} {UPLOAD_EXPIRED_MESSAGE}"
+            else:
+                text = f"{IMAGES['error']} Пожалуйста, сначала отправьте изображение для конвертации."
+            await update.message.reply_text(text=text)
+            return
+        
+        # Get settings
+        settings = get_user_settings(context)
+        
+        # Уже отправленные результаты берем из кэша, кодируем только остальные
+        max_kb = settings.get('image_max_kb')
+        max_side = settings.get('image_max_side')
+        if not (metadata_type or max_kb or max_side):
+            # Без новых метаданных и ограничений исходный формат дал бы ту же картинку заново
+            target_formats = [target_format for target_format in target_formats
+                              if target_format.upper() != upload.get('format')]
+        items = []
+        for target_format in target_formats:
+            cache_key = ResultCache.make_key(
+                upload.get('file_unique_id'), target_format, metadata_type,
+                quality=settings['image_quality'], optimize=settings['optimize_size'], exif=settings['maintain_exif'],
+                max_kb=max_kb, max_side=max_side
+            )
+            items.append([cache_key, await lookup_result(cache_key), f"converted_image.{target_format.lower()}"])
+        
+        missing = [index for index, item in enumerate(items) if item[1] is None]
+        if missing:
+            source = upload['path'] if 'path' in upload else upload['bytes']
+            exif_bytes = create_exif_dict(metadata_type) if metadata_type else None
+            max_bytes = max_kb * 1024 if max_kb else None
+            formats = [target_formats[index].upper() for index in missing]
+            outputs = {}
+            if exif_bytes and 'JPG' in formats and not max_side:
+                # JPEG -> JPG с новыми метаданными: меняем только EXIF, без перекодирования
+                data = await run_in_process(retag_jpeg, source, exif_bytes, settings['maintain_exif'])
+                if data is not None and (not max_bytes or len(data) <= max_bytes):
+                    outputs['JPG'] = data
+            encode_formats = [target_format for target_format in formats if target_format not in outputs]
+            if encode_formats:
+                # Исходник декодируется один раз, затем каждый формат кодируется из готовых пикселей
+                # в своем процессе пула: Pillow держит GIL при кодировании, в потоках форматы шли бы по очереди
+                img = await run_in_process(decode_image, source, max_side)
+                encoded = await asyncio.gather(*[
+                    run_in_process(
+                        encode_decoded, img, target_format,
+                        settings['image_quality'], settings['optimize_size'], exif_bytes, settings['maintain_exif'],
+                        max_bytes
+                    )
+                    for target_format in encode_formats
+                ])
+                outputs.update(zip(encode_formats, encoded))
+            for index, target_format in zip(missing, formats):
+                items[index][1] = outputs[target_format]
+        
+        formats_text = ', '.join(target_format.upper() for target_format in target_formats)
+        await reply_document_group(
+            update.message, [tuple(item) for item in items],
+            caption=f"Вот ваше изображение в форматах {formats_text}! ✨"
+        )
+        
+        await update.message.reply_text(
+            text=f"{IMAGES['success']} Конвертация завершена успешно!\n"
+                 f"• Форматы: {formats_text}\n"
+                 f"• Метаданные: {metadata_type if metadata_type else 'без изменений'}"
+        )
+        
+        # Clear the stored image
+        PENDING_UPLOADS.discard(user_id, 'image')
+        
+    except ImageSizeError as e:
+        await update.message.reply_text(
+            text=f"{IMAGES['error']} {str(e)}"
+        )
+    except Exception as e:
+        logger.error(f"Error converting image to several formats: {str(e)}", exc_info=True)
         await update.message.reply_text(
             text=f"{IMAGES['error']} Извините, произошла ошибка при конвертации. Пожалуйста, попробуйте снова."
         ) 
\ No newline at end of file
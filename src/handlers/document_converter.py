@@ -1,91 +1,239 @@
 import io
 import os
+import re
+import sys
+import asyncio
 import logging
-import tempfile
+import itertools
 from pathlib import Path
+from typing import Iterator, Optional, Tuple
 from telegram import Update
 from telegram.ext import ContextTypes
-from docx2pdf import convert
 from pdf2docx import Converter
-from PyPDF2 import PdfReader, PdfWriter
 import mammoth
 from src.keyboards import get_doc_format_keyboard
-from src.config import IMAGES
+from src.config import IMAGES, UPLOAD_EXPIRED_MESSAGE, PDF_DOCX_PROCESSES, PDF_DOCX_PARALLEL_PAGES, PPTX_MAX_SLIDES
+from src.spool import SPOOL, download_upload, upload_to_path
+from src.office import convert_to_pdf
+from src.textpdf import FontMissingError, detect_encoding, text_to_pdf
+from src.pdftext import PageRangeError, count_pages, page_slice, pdf_to_text
+from src.workers import run_in_process
+from src.pending import PENDING_UPLOADS
+from src.result_cache import ResultCache, reply_cached, reply_result
 from docx import Document
+from docx.enum.style import WD_STYLE_TYPE
+from docx.oxml.ns import qn
+from docx.text.paragraph import Paragraph
 from pptx import Presentation
 from pptx.util import Inches, Pt
 
 logger = logging.getLogger(__name__)
 
-async def convert_docx_to_pptx(docx_path: str, pptx_path: str) -> bool:
-    """Convert DOCX document to PPTX presentation."""
+PPTX_LINES_PER_SLIDE = 5  # Абзацев текста на одном слайде
+
+# "5", "1-10" или "5-" (до конца документа)
+PAGE_RANGE_PATTERN = re.compile(r'^\s*(\d+)\s*(?:([-–])\s*(\d+)?)?\s*$')
+
+def parse_page_range(text: str) -> Optional[Tuple[int, Optional[int]]]:
+    """Parse a 1-based page range; last is None for "to the end". None if the text is not a range."""
+    match = PAGE_RANGE_PATTERN.match(text)
+    if not match:
+        return None
+    first = int(match.group(1))
+    if match.group(3):
+        last = int(match.group(3))
+    else:
+        last = None if match.group(2) else first
+    if first < 1 or (last is not None and last < first):
+        return None
+    return first, last
+
+def format_page_range(pages: Tuple[int, Optional[int]]) -> str:
+    """Human-readable page range."""
+    first, last = pages
+    if last == first:
+        return str(first)
+    return f"{first}–{last if last else 'конец'}"
+
+def pdf_to_docx(source_path: str, target_path: str, start: int, stop: int) -> None:
+    """Convert pages [start, stop) of a PDF to DOCX with pdf2docx."""
+    cv = Converter(source_path)
     try:
-        # Открываем документ Word
-        doc = Document(docx_path)
-        # Создаем новую презентацию
-        prs = Presentation()
-        
-        # Настройки слайда
-        title_slide_layout = prs.slide_layouts[0]  # Title Slide
-        content_slide_layout = prs.slide_layouts[1]  # Title and Content
-        
-        # Создаем титульный слайд
-        title_slide = prs.slides.add_slide(title_slide_layout)
-        title = title_slide.shapes.title
-        subtitle = title_slide.placeholders[1]
-        
-        # Устанавливаем заголовок из первого параграфа документа
-        if doc.paragraphs:
-            title.text = doc.paragraphs[0].text
-            if len(doc.paragraphs) > 1:
-                subtitle.text = doc.paragraphs[1].text
-        
-        # Обрабатываем остальной текст
-        current_slide = None
-        current_text = []
-        
-        for para in doc.paragraphs[2:]:
-            # Если это заголовок, создаем новый слайд
-            if para.style.name.startswith('Heading'):
-                # Сохраняем текст предыдущего слайда
-                if current_slide and current_text:
-                    content = current_slide.shapes.placeholders[1]
-                    content.text = "\n".join(current_text)
-                    current_text = []
-                
-                # Создаем новый слайд
-                current_slide = prs.slides.add_slide(content_slide_layout)
-                title = current_slide.shapes.title
-                title.text = para.text
-            else:
-                # Добавляем текст к текущему слайду
-                if para.text.strip():
-                    current_text.append(para.text)
-                    
-                    # Если накопилось много текста, создаем новый слайд
-                    if len(current_text) >= 5:
-                        if not current_slide:
-                            current_slide = prs.slides.add_slide(content_slide_layout)
-                            title = current_slide.shapes.title
-                            title.text = "Продолжение"
-                        
-                        content = current_slide.shapes.placeholders[1]
-                        content.text = "\n".join(current_text)
-                        current_text = []
-                        current_slide = None
-        
-        # Сохраняем последний слайд
-        if current_slide and current_text:
-            content = current_slide.shapes.placeholders[1]
-            content.text = "\n".join(current_text)
-        
-        # Сохраняем презентацию
-        prs.save(pptx_path)
-        return True
-        
-    except Exception as e:
-        logger.error(f"Error converting DOCX to PPTX: {str(e)}", exc_info=True)
-        return False
+        cv.convert(target_path, start=start, end=stop)
+    finally:
+        cv.close()
+
+# В режиме multi_processing pdf2docx пишет pages-N.json в текущий каталог и не закрывает свой Pool,
+# поэтому такая конвертация идет в отдельном процессе с рабочим каталогом задачи
+PDF_DOCX_PARALLEL_SCRIPT = '''
+import sys
+from pdf2docx import Converter
+source_path, target_path, start, stop, processes = sys.argv[1:]
+cv = Converter(source_path)
+cv.convert(target_path, start=int(start), end=int(stop), multi_processing=True, cpu_count=int(processes))
+cv.close()
+'''
+
+async def pdf_to_docx_parallel(source_path: str, target_path: str, start: int, stop: int, work_dir: str) -> None:
+    """Convert pages [start, stop) with pdf2docx's multi-processing mode in a child process."""
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, '-c', PDF_DOCX_PARALLEL_SCRIPT, os.path.abspath(source_path), os.path.abspath(target_path),
+        str(start), str(stop), str(PDF_DOCX_PROCESSES),
+        cwd=work_dir, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        _, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+    if process.returncode != 0:
+        message = stderr.decode('utf-8', errors='replace').strip().splitlines()
+        raise RuntimeError(f"pdf2docx failed: {message[-1] if message else process.returncode}")
+
+class SlideBuilder:
+    """Build slides from a stream of headings and text paragraphs.
+
+    A slide is added once its title and text are known, so every text frame
+    is written once. After max_slides slides the rest of the document is
+    skipped and `truncated` is set.
+    """
+
+    def __init__(self, prs, max_slides: int = PPTX_MAX_SLIDES):
+        self.prs = prs
+        self.max_slides = max_slides
+        self.slides = 0
+        self.truncated = False
+        self.title = None
+        self.lines = []
+
+    def add_slide(self, layout: int, title: Optional[str], text: Optional[str] = None) -> None:
+        """Add one slide with its title and content placeholder filled in."""
+        if self.slides >= self.max_slides:
+            self.truncated = True
+            return
+        slide = self.prs.slides.add_slide(self.prs.slide_layouts[layout])
+        self.slides += 1
+        if title is not None:
+            slide.shapes.title.text = title
+        if text is not None:
+            slide.placeholders[1].text = text
+
+    def heading(self, title: str) -> None:
+        """Start a new slide titled with the heading."""
+        self.flush()
+        self.title = title
+
+    def paragraph(self, text: str) -> None:
+        """Add a paragraph to the current slide, closing it when it is full."""
+        if not text.strip():
+            return
+        self.lines.append(text)
+        # Если накопилось много текста, переходим на новый слайд
+        if len(self.lines) >= PPTX_LINES_PER_SLIDE:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the pending slide, if any."""
+        if self.title is None and not self.lines:
+            return
+        title = self.title if self.title is not None else "Продолжение"
+        self.add_slide(1, title, "\n".join(self.lines) if self.lines else None)  # Title and Content
+        self.title = None
+        self.lines = []
+
+def iter_paragraphs(doc) -> Iterator[Tuple[str, str]]:
+    """Yield (style name, text) of the body paragraphs one by one."""
+    style_names = {}
+    for element in doc.element.body.iterchildren(qn('w:p')):
+        # Имя стиля ищется в styles.xml, поэтому запоминаем его для каждого style id
+        style_id = element.style
+        if style_id not in style_names:
+            style_names[style_id] = doc.part.get_style(style_id, WD_STYLE_TYPE.PARAGRAPH).name
+        yield style_names[style_id], Paragraph(element, doc._body).text
+
+def docx_to_pptx(docx_path: str, pptx_path: str, max_slides: int = PPTX_MAX_SLIDES) -> int:
+    """Convert DOCX document to PPTX presentation; returns the number of slides."""
+    doc = Document(docx_path)
+    prs = Presentation()
+    builder = SlideBuilder(prs, max_slides)
+    paragraphs = iter_paragraphs(doc)
+    
+    # Титульный слайд: первый абзац - заголовок, второй - подзаголовок
+    head = [text for _, text in itertools.islice(paragraphs, 2)]
+    builder.add_slide(0, head[0] if head else None, head[1] if len(head) > 1 else None)
+    
+    # Заголовки документа открывают новые слайды
+    for style_name, text in paragraphs:
+        if style_name.startswith('Heading'):
+            builder.heading(text)
+        else:
+            builder.paragraph(text)
+        if builder.truncated:
+            break
+    builder.flush()
+    
+    if builder.truncated:
+        logger.info(f"Presentation truncated to {max_slides} slides")
+    prs.save(pptx_path)
+    return builder.slides
+
+def document_work_dir(doc_info: dict):
+    """Work directory in the spool, inside the upload's job directory if it has one."""
+    return SPOOL.work_dir(doc_info.get('spool_dir'), reserve=doc_info['size'] * 3)
+
+async def render_document(doc_info: dict, target_format: str, temp_dir: str) -> Path:
+    """Convert the uploaded document in the work directory and return the result path."""
+    source_type = doc_info['type']
+    
+    target_path = os.path.join(temp_dir, f"target.{target_format.lower()}")
+    
+    # Write source file (spooled uploads are read in place)
+    source_path = upload_to_path(doc_info, os.path.join(temp_dir, f"source.{source_type.lower()}"))
+    
+    # Convert based on source and target formats
+    if source_type == 'PDF' and target_format == 'DOCX':
+        start, stop = page_slice(doc_info.get('pages'), await run_in_process(count_pages, source_path))
+        if PDF_DOCX_PROCESSES != 1 and stop - start >= PDF_DOCX_PARALLEL_PAGES:
+            # pdf2docx запускает свой пул процессов, а процессы общего пула не могут порождать дочерние
+            await pdf_to_docx_parallel(source_path, target_path, start, stop, temp_dir)
+        else:
+            await run_in_process(pdf_to_docx, source_path, target_path, start, stop)
+    
+    elif source_type == 'PDF' and target_format == 'TXT':
+        pages = await pdf_to_text(source_path, target_path, temp_dir, doc_info.get('pages'))
+        logger.info(f"PDF text extracted: {pages} pages")
+    
+    elif source_type in ['DOC', 'DOCX'] and target_format == 'PDF':
+        await convert_to_pdf(source_path, target_path)
+    
+    elif source_type in ['DOC', 'DOCX'] and target_format == 'PPTX':
+        slides = await run_in_process(docx_to_pptx, source_path, target_path)
+        logger.info(f"DOCX converted to PPTX: {slides} slides")
+    
+    elif source_type in ['DOC', 'DOCX'] and target_format == 'TXT':
+        with open(source_path, 'rb') as docx_file:
+            result = mammoth.extract_raw_text(docx_file)
+            with open(target_path, 'w', encoding='utf-8') as txt_file:
+                txt_file.write(result.value)
+    
+    elif source_type == 'TXT' and target_format == 'PDF':
+        # Страницы пишутся по мере чтения текста, без промежуточного DOCX
+        pages = await run_in_process(text_to_pdf, source_path, target_path)
+        logger.info(f"TXT rendered to PDF: {pages} pages")
+    
+    elif source_type == 'TXT' and target_format == 'DOCX':
+        doc = Document()
+        with open(source_path, 'r', encoding=detect_encoding(source_path), errors='replace') as txt_file:
+            content = txt_file.read()
+            doc.add_paragraph(content)
+        doc.save(target_path)
+    
+    else:
+        raise ValueError(f"Unsupported document conversion: {source_type} -> {target_format}")
+    
+    return Path(target_path)
 
 async def handle_document_conversion(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle document messages for conversion."""
@@ -113,15 +261,15 @@ async def handle_document_conversion(update: Update, context: ContextTypes.DEFAU
             return
             
         # Download document
-        doc_file = await context.bot.get_file(document.file_id)
-        doc_bytes = await doc_file.download_as_bytearray()
+        upload = await download_upload(context.bot, document.file_id, file_name)
         
-        # Store document info in context
-        context.user_data['current_document'] = {
-            'bytes': doc_bytes,
+        # Store the document until the user picks a format
+        PENDING_UPLOADS.put(update.effective_user.id, 'document', {
+            **upload,
             'name': file_name,
-            'type': supported_types[mime_type]
-        }
+            'type': supported_types[mime_type],
+            'file_unique_id': document.file_unique_id
+        })
         
         # Если это DOCX, предлагаем дополнительные опции
         if supported_types[mime_type] == 'DOCX':
@@ -131,21 +279,22 @@ async def handle_document_conversion(update: Update, context: ContextTypes.DEFAU
                      "2. PPTX (Презентация)\n"
                      "Отправьте номер нужного формата (1 или 2):"
             )
-            # Сохраняем путь к файлу для последующей конвертации
-            with tempfile.TemporaryDirectory() as temp_dir:
-                source_path = os.path.join(temp_dir, file_name)
-                with open(source_path, 'wb') as f:
-                    f.write(doc_bytes)
-                context.user_data['current_file'] = {
-                    'path': source_path,
-                    'name': file_name,
-                    'mime_type': mime_type
-                }
+            # Сам файл хранится в PENDING_UPLOADS, здесь только ожидание выбора
+            context.user_data['current_file'] = {
+                'name': file_name,
+                'mime_type': mime_type
+            }
         else:
+            # Ответ "1"/"2" относится только к последнему DOCX, а этот файл другого типа
+            context.user_data.pop('current_file', None)
+            
             # Для других форматов показываем стандартную клавиатуру
             keyboard = get_doc_format_keyboard(supported_types[mime_type])
+            hint = ""
+            if supported_types[mime_type] == 'PDF':
+                hint = "\n\nЧтобы конвертировать только часть страниц, отправьте их диапазон, например 1-10"
             await update.message.reply_text(
-                text=f"{IMAGES['formats']}\nВыберите формат для конвертации:",
+                text=f"{IMAGES['formats']}\nВыберите формат для конвертации:{hint}",
                 reply_markup=keyboard
             )
         
@@ -158,72 +307,38 @@ async def handle_document_conversion(update: Update, context: ContextTypes.DEFAU
 async def convert_document(update: Update, context: ContextTypes.DEFAULT_TYPE, target_format: str) -> None:
     """Convert document to target format."""
     try:
-        if 'current_document' not in context.user_data:
-            await update.message.reply_text(
-                text=f"{IMAGES['error']} Пожалуйста, сначала отправьте документ для конвертации."
-            )
+        user_id = update.effective_user.id
+        doc_info = PENDING_UPLOADS.get(user_id, 'document')
+        if doc_info is None:
+            if PENDING_UPLOADS.expired(user_id, 'document'):
+                text = f"{IMAGES['error']} {UPLOAD_EXPIRED_MESSAGE}"
+            else:
+                text = f"{IMAGES['error']} Пожалуйста, сначала отправьте документ для конвертации."
+            await update.message.reply_text(text=text)
             return
             
-        doc_info = context.user_data['current_document']
-        source_bytes = doc_info['bytes']
         source_type = doc_info['type']
         original_name = Path(doc_info['name']).stem
         
-        # Create temporary directory for conversion
-        with tempfile.TemporaryDirectory() as temp_dir:
-            source_path = os.path.join(temp_dir, f"source.{source_type.lower()}")
-            target_path = os.path.join(temp_dir, f"target.{target_format.lower()}")
-            
-            # Write source file
-            with open(source_path, 'wb') as f:
-                f.write(source_bytes)
-            
-            # Convert based on source and target formats
-            if source_type == 'PDF' and target_format == 'DOCX':
-                cv = Converter(source_path)
-                cv.convert(target_path)
-                cv.close()
-            
-            elif source_type in ['DOC', 'DOCX'] and target_format == 'PDF':
-                convert(source_path, target_path)
-            
-            elif source_type in ['DOC', 'DOCX'] and target_format == 'PPTX':
-                success = await convert_docx_to_pptx(source_path, target_path)
-                if not success:
-                    raise Exception("Failed to convert to PPTX")
-            
-            elif source_type in ['DOC', 'DOCX'] and target_format == 'TXT':
-                with open(source_path, 'rb') as docx_file:
-                    result = mammoth.extract_raw_text(docx_file)
-                    with open(target_path, 'w', encoding='utf-8') as txt_file:
-                        txt_file.write(result.value)
-            
-            elif source_type == 'TXT' and target_format in ['PDF', 'DOCX']:
-                doc = Document()
-                with open(source_path, 'r', encoding='utf-8') as txt_file:
-                    content = txt_file.read()
-                    doc.add_paragraph(content)
-                doc.save(target_path if target_format == 'DOCX' else source_path + '.docx')
-                
-                if target_format == 'PDF':
-                    convert(source_path + '.docx', target_path)
-            
-            # Read converted file
-            with open(target_path, 'rb') as f:
-                output_bytes = f.read()
-            
         # Send converted file with appropriate caption
         caption = "Вот ваш документ в формате"
         if target_format == 'PPTX':
             caption = f"{caption} PPTX! ✨\n• Заголовки документа преобразованы в слайды\n• Текст разделен на удобные для чтения части\n• Сохранено форматирование заголовков"
         else:
             caption = f"{caption} {target_format}! ✨"
-            
-        await update.message.reply_document(
-            document=output_bytes,
-            filename=f"{original_name}.{target_format.lower()}",
-            caption=caption
-        )
+        
+        pages = doc_info.get('pages')
+        if pages:
+            caption += f"\n• Страницы: {format_page_range(pages)}"
+        
+        cache_key = ResultCache.make_key(doc_info.get('file_unique_id'), target_format,
+                                         **({'pages': list(pages)} if pages else {}))
+        if not await reply_cached(update.message, cache_key, caption):
+            # The result is uploaded from the work directory before it is removed
+            with document_work_dir(doc_info) as temp_dir:
+                output_path = await render_document(doc_info, target_format, temp_dir)
+                await reply_result(update.message, cache_key, output_path,
+                                   f"{original_name}.{target_format.lower()}", caption)
         
         # Send success message
         success_msg = f"{IMAGES['success']} Конвертация завершена успешно!\n\n📄 Исходный формат: {source_type}\n📑 Новый формат: {target_format}"
@@ -233,18 +348,59 @@ async def convert_document(update: Update, context: ContextTypes.DEFAULT_TYPE, t
         await update.message.reply_text(text=success_msg)
         
         # Clear the stored document
-        del context.user_data['current_document']
+        PENDING_UPLOADS.discard(user_id, 'document')
         
+    except PageRangeError as e:
+        await update.message.reply_text(
+            text=f"{IMAGES['error']} {str(e)} Отправьте другой диапазон."
+        )
+    except FontMissingError as e:
+        logger.error(f"Error converting document: {str(e)}")
+        await update.message.reply_text(
+            text=f"{IMAGES['error']} {str(e)}"
+        )
     except Exception as e:
         logger.error(f"Error converting document: {str(e)}")
         await update.message.reply_text(
             text=f"{IMAGES['error']} Извините, произошла ошибка при конвертации. Пожалуйста, попробуйте снова."
         )
 
+def has_pending_pdf(user_id: int) -> bool:
+    """Check whether the user's pending document is a PDF."""
+    doc_info = PENDING_UPLOADS.get(user_id, 'document')
+    return doc_info is not None and doc_info['type'] == 'PDF'
+
+async def set_page_range(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Remember which pages of the pending PDF to convert."""
+    doc_info = PENDING_UPLOADS.get(update.effective_user.id, 'document')
+    if doc_info is None or doc_info['type'] != 'PDF':
+        await update.message.reply_text(
+            text=f"{IMAGES['error']} Диапазон страниц можно указать только для PDF. Сначала отправьте документ."
+        )
+        return
+    
+    pages = parse_page_range(update.message.text)
+    if pages is None:
+        await update.message.reply_text(
+            text=f"{IMAGES['error']} Неверный диапазон страниц. Пример: 1-10"
+        )
+        return
+    
+    doc_info['pages'] = pages
+    await update.message.reply_text(
+        text=f"{IMAGES['settings']} Страницы для конвертации: {format_page_range(pages)}\n"
+             "Теперь выберите формат:",
+        reply_markup=get_doc_format_keyboard('PDF')
+    )
+
 async def handle_conversion_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle user's choice for document conversion."""
     try:
         if 'current_file' not in context.user_data:
+            if has_pending_pdf(update.effective_user.id):
+                # "1" или "2" без ожидающего выбора DOCX - это номер страницы PDF
+                await set_page_range(update, context)
+                return
             await update.message.reply_text(
                 text=f"{IMAGES['error']} Пожалуйста, сначала отправьте документ."
             )
@@ -252,57 +408,44 @@ async def handle_conversion_choice(update: Update, context: ContextTypes.DEFAULT
         
         choice = update.message.text.strip()
         file_info = context.user_data['current_file']
-        source_path = file_info['path']
         file_name = file_info['name']
+        user_id = update.effective_user.id
+        doc_info = PENDING_UPLOADS.get(user_id, 'document')
+        if doc_info is None:
+            del context.user_data['current_file']
+            if PENDING_UPLOADS.expired(user_id, 'document'):
+                text = f"{IMAGES['error']} {UPLOAD_EXPIRED_MESSAGE}"
+            else:
+                text = f"{IMAGES['error']} Пожалуйста, сначала отправьте документ."
+            await update.message.reply_text(text=text)
+            return
         
-        with tempfile.TemporaryDirectory() as temp_dir:
-            if choice == '1':
-                # Convert DOCX to PDF
-                target_path = os.path.join(temp_dir, Path(file_name).stem + '.pdf')
-                convert(source_path, target_path)
-                
-                # Read converted file
-                with open(target_path, 'rb') as f:
-                    output_bytes = f.read()
-                
-                # Send converted file
-                await update.message.reply_document(
-                    document=output_bytes,
-                    filename=Path(file_name).stem + '.pdf',
-                    caption="Вот ваш документ в формате PDF! ✨"
-                )
-                
-            elif choice == '2':
-                # Convert DOCX to PPTX
-                target_path = os.path.join(temp_dir, Path(file_name).stem + '.pptx')
-                success = await convert_docx_to_pptx(source_path, target_path)
-                
-                if success:
-                    # Read converted file
-                    with open(target_path, 'rb') as f:
-                        output_bytes = f.read()
+        choices = {
+            '1': ('PDF', "Вот ваш документ в формате PDF! ✨"),
+            '2': ('PPTX', "Вот ваша презентация! ✨\n"
+                          "• Заголовки документа преобразованы в слайды\n"
+                          "• Текст разделен на удобные для чтения части\n"
+                          "• Сохранено форматирование заголовков")
+        }
+        
+        if choice in choices:
+            target_format, caption = choices[choice]
+            cache_key = ResultCache.make_key(doc_info.get('file_unique_id'), target_format)
+            if not await reply_cached(update.message, cache_key, caption):
+                with document_work_dir(doc_info) as temp_dir:
+                    output_path = await render_document(doc_info, target_format, temp_dir)
                     
                     # Send converted file
-                    await update.message.reply_document(
-                        document=output_bytes,
-                        filename=Path(file_name).stem + '.pptx',
-                        caption="Вот ваша презентация! ✨\n"
-                                "• Заголовки документа преобразованы в слайды\n"
-                                "• Текст разделен на удобные для чтения части\n"
-                                "• Сохранено форматирование заголовков"
-                    )
-                else:
-                    await update.message.reply_text(
-                        text=f"{IMAGES['error']} Не удалось конвертировать документ в презентацию."
-                    )
-            
-            else:
-                await update.message.reply_text(
-                    text=f"{IMAGES['error']} Пожалуйста, выберите 1 (PDF) или 2 (PPTX)."
-                )
+                    await reply_result(update.message, cache_key, output_path,
+                                       f"{Path(file_name).stem}.{target_format.lower()}", caption)
+        else:
+            await update.message.reply_text(
+                text=f"{IMAGES['error']} Пожалуйста, выберите 1 (PDF) или 2 (PPTX)."
+            )
         
         # Clear stored file info
         del context.user_data['current_file']
+        PENDING_UPLOADS.discard(user_id, 'document')
         
     except Exception as e:
         logger.error(f"Error handling conversion choice: {str(e)}", exc_info=True)
@@ -1,8 +1,8 @@
 import os
 import io
+import shutil
+import asyncio
 import logging
-import tempfile
-import subprocess
 from datetime import datetime
 from pathlib import Path
 from telegram import Update
@@ -10,53 +10,270 @@ from telegram.ext import ContextTypes
 from mutagen.mp4 import MP4, MP4Cover
 from mutagen.id3 import ID3, TIT2, TPE1, TDRC
 from src.keyboards import get_video_format_keyboard, get_metadata_keyboard
-from src.config import IMAGES, METADATA_PRESETS, DEFAULT_SETTINGS
+from src.config import (IMAGES, METADATA_PRESETS, DEFAULT_SETTINGS, UPLOAD_EXPIRED_MESSAGE,
+                        SEGMENT_MIN_DURATION, SEGMENT_COUNT, UPLOAD_LIMIT_BYTES, VIDEO_TWO_PASS,
+                        MIN_VIDEO_BITRATE, VIDEO_PRESETS, VIDEO_PRESET, VIDEO_PRESET_OVERRIDE,
+                        VIDEO_PRESET_LABELS, PIPE_MAX_BYTES)
+from src import ffmpeg_runner
+from src.ffmpeg_runner import FFmpegCancelled, FFmpegError, FFmpegTimeout
+from src.spool import SPOOL, download_upload, upload_to_path
+from src.pending import PENDING_UPLOADS
+from src.result_cache import ResultCache, lookup_result, reply_cached, reply_result, reply_document_group
+from src.progress import ProgressReporter, format_duration
+from src.probe import MediaInfo, probe_media
 
 logger = logging.getLogger(__name__)
 
-# Добавляем путь к FFmpeg
-FFMPEG_BIN = r"C:\ffmpeg\bin"
-FFMPEG_EXE = os.path.join(FFMPEG_BIN, "ffmpeg.exe")
-FFPROBE_EXE = os.path.join(FFMPEG_BIN, "ffprobe.exe")
+FIT_SIZE_MARGIN = 0.95  # Запас на контейнер и неточность битрейта
 
-def run_ffmpeg(input_path, output_path, metadata=None):
-    """Run FFmpeg command with the specified parameters."""
-    command = [FFMPEG_EXE, '-i', input_path]
+# Контейнеры, которые FFmpeg пишет в stdout без перемотки (MP4/MOV - фрагментированными).
+# MKV сюда не входит: без перемотки Matroska остается без длительности и индекса (Cues)
+PIPE_MUXERS = {'MP4': 'mp4', 'MOV': 'mov'}
+PIPE_MOVFLAGS = '+frag_keyframe+empty_moov+default_base_moof'
+
+# Контейнер исходника по MIME-типу, если у файла нет расширения
+VIDEO_MIME_FORMATS = {'video/mp4': 'MP4', 'video/quicktime': 'MOV', 'video/x-msvideo': 'AVI', 'video/x-matroska': 'MKV'}
+
+class SizeLimitError(Exception):
+    """The result cannot fit into the Telegram upload limit."""
+
+async def run_ffmpeg(input_path, output_path, metadata=None, owner=None, codec_args=None, job=None,
+                     progress=None):
+    """Run FFmpeg command with the specified parameters.
+
+    input_path may also be a list of ready input arguments (several inputs);
+    progress is a line callback for the -progress output.
+    """
+    command = ['-progress', 'pipe:1', '-nostats'] if progress else []
+    command.extend(input_path if isinstance(input_path, list) else ['-i', input_path])
+    
+    if codec_args:
+        command.extend(codec_args)
     
     if metadata:
         for key, value in metadata.items():
             command.extend(['-metadata', f'{key}={value}'])
     
-    command.extend(['-y', output_path])
+    command.append(output_path)
     
-    try:
-        result = subprocess.run(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            check=True
-        )
-        return True
-    except subprocess.CalledProcessError as e:
-        logger.error(f"FFmpeg error: {e.stderr}")
-        raise RuntimeError(f"Ошибка при конвертации: {e.stderr}")
+    await ffmpeg_runner.run_ffmpeg(command, owner=owner, job=job, on_stdout_line=progress)
+    return True
 
-def probe_video(input_path):
-    """Check if video file is valid using FFprobe."""
-    try:
-        result = subprocess.run(
-            [FFPROBE_EXE, input_path],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
+def get_video_preset(settings: dict) -> str:
+    """Name of the encoder preset for the user; the operator override wins."""
+    name = VIDEO_PRESET_OVERRIDE or settings.get('video_preset', VIDEO_PRESET)
+    return name if name in VIDEO_PRESETS else VIDEO_PRESET
+
+def encoder_args(codec_type: str, encoder: str, spec: str, preset: dict, video_bitrate: int = None):
+    """Encoder and preset options for one output stream (spec is an FFmpeg stream specifier)."""
+    args = [f'-c:{spec}', encoder]
+    if codec_type == 'video':
+        if video_bitrate:
+            args.extend([f'-b:{spec}', str(video_bitrate)])
+        if encoder == 'libx264':
+            args.extend([f'-preset:{spec}', preset['x264_preset']])
+            if not video_bitrate:
+                args.extend([f'-crf:{spec}', str(preset['crf'])])
+        elif encoder == 'mpeg4' and not video_bitrate:
+            args.extend([f'-q:{spec}', str(preset['mpeg4_quality'])])
+        if preset['threads']:
+            args.extend([f'-threads:{spec}', str(preset['threads'])])
+    elif codec_type == 'audio':
+        args.extend([f'-b:{spec}', str(preset['audio_bitrate'])])
+    return args
+
+def build_codec_args(info: MediaInfo, target_format: str, segmented: bool = False, video_bitrate: int = None,
+                     preset: dict = None):
+    """Choose stream copy or re-encoding for every stream of the source.
+
+    Returns FFmpeg mapping/codec arguments and whether all streams are copied.
+    With segmented=True input 0 is the concatenated, already encoded video and
+    the remaining streams are taken from the source as input 1. A video_bitrate
+    forces the video to be re-encoded at that bitrate. Re-encoded streams use
+    the preset (VIDEO_PRESET by default).
+    """
+    target_format = target_format.upper()
+    preset = preset or VIDEO_PRESETS[VIDEO_PRESET]
+    allowed = CONTAINER_CODECS[target_format]
+    encoders = DEFAULT_ENCODERS[target_format]
+    args = []
+    copied_all = True
+    output_index = 0
+    video_stream = info.video
+    
+    for stream in info.streams:
+        codec_type = stream.codec_type
+        codec_name = stream.codec_name
+        
+        if codec_type == 'video':
+            # Обложки (attached_pic) и дополнительные видеодорожки пропускаем
+            if stream is not video_stream:
+                continue
+            if segmented:
+                args.extend(['-map', '0:v:0', f'-c:{output_index}', 'copy'])
+                output_index += 1
+                continue
+        elif codec_type == 'subtitle':
+            # Растровые субтитры нельзя перевести в текстовый формат
+            if codec_name not in allowed['subtitle'] and (
+                    not encoders['subtitle'] or codec_name not in TEXT_SUBTITLE_CODECS):
+                continue
+        elif codec_type != 'audio':
+            continue
+        
+        args.extend(['-map', f"{1 if segmented else 0}:{stream.index}"])
+        if codec_name in allowed[codec_type] and not (codec_type == 'video' and video_bitrate):
+            args.extend([f'-c:{output_index}', 'copy'])
+            if codec_name == 'hevc' and target_format in ['MP4', 'MOV']:
+                args.extend([f'-tag:{output_index}', 'hvc1'])
+        else:
+            args.extend(encoder_args(codec_type, encoders[codec_type], str(output_index), preset, video_bitrate))
+            copied_all = False
+        output_index += 1
+    
+    return args, copied_all
+
+def fit_video_bitrate(info: MediaInfo, target_format: str, budget: int, preset: dict = None) -> int:
+    """Pick the average video bitrate that keeps the output within budget bytes.
+
+    Raises SizeLimitError when even MIN_VIDEO_BITRATE would not fit.
+    """
+    budget_mb = budget / (1024 * 1024)
+    duration = info.duration
+    if duration <= 0:
+        raise SizeLimitError(f"Не удалось определить длительность видео, чтобы уложиться в {budget_mb:.0f} МБ.")
+    
+    audio_codecs = CONTAINER_CODECS[target_format.upper()]['audio']
+    encoded_audio_bitrate = int((preset or VIDEO_PRESETS[VIDEO_PRESET])['audio_bitrate'])
+    audio_bitrate = 0
+    for stream in info.audio:
+        if stream.codec_name in audio_codecs:
+            audio_bitrate += stream.bit_rate or encoded_audio_bitrate
+        else:
+            audio_bitrate += encoded_audio_bitrate
+    
+    video_bitrate = int(budget * 8 * FIT_SIZE_MARGIN / duration) - audio_bitrate
+    if video_bitrate < MIN_VIDEO_BITRATE:
+        raise SizeLimitError(
+            f"Видео длиной {format_duration(duration)} не уложится в лимит Telegram "
+            f"({budget_mb:.0f} МБ) даже при минимальном качестве."
         )
-        return result.returncode == 0
-    except Exception as e:
-        logger.error(f"FFprobe error: {str(e)}")
-        return False
+    return video_bitrate
+
+def estimate_output_size(info: MediaInfo, target_format: str, preset: dict = None) -> int:
+    """Rough size of the converted file in bytes from the probed bitrates and duration."""
+    duration = info.duration
+    if duration <= 0:
+        return info.size or 0
+    target_format = target_format.upper()
+    allowed = CONTAINER_CODECS[target_format]
+    preset = preset or VIDEO_PRESETS[VIDEO_PRESET]
+    
+    audio_bitrate = 0
+    for stream in info.audio:
+        if stream.codec_name in allowed['audio']:
+            audio_bitrate += stream.bit_rate or preset['audio_bitrate']
+        else:
+            audio_bitrate += preset['audio_bitrate']
+    
+    video_bitrate = 0
+    video = info.video
+    if video:
+        total_bitrate = info.bit_rate or (info.size * 8 / duration if info.size else 0)
+        video_bitrate = video.bit_rate or max(total_bitrate - sum(s.bit_rate or 0 for s in info.audio), 0)
+        if video.codec_name not in allowed['video']:
+            video_bitrate *= ENCODER_SIZE_FACTORS.get(DEFAULT_ENCODERS[target_format]['video'], 1.0)
+    return int((video_bitrate + audio_bitrate) * duration / 8)
+
+def upload_video_bitrate(info: MediaInfo, source_size: int, target_format: str, preset: dict = None):
+    """Video bitrate that keeps the result within the upload limit; None when it fits as is.
+
+    Copied streams keep the source size; when streams are re-encoded the size
+    is estimated from the probed bitrates, so a result that would grow past
+    the limit is fitted before encoding instead of being refused after it.
+    """
+    _, copied_all = build_codec_args(info, target_format, preset=preset)
+    estimate = source_size if copied_all else estimate_output_size(info, target_format, preset)
+    if estimate <= UPLOAD_LIMIT_BYTES:
+        return None
+    video_bitrate = fit_video_bitrate(info, target_format, UPLOAD_LIMIT_BYTES, preset)
+    logger.info(f"Estimated {target_format} size {estimate} bytes exceeds the upload limit, "
+                f"encoding video at {video_bitrate} bit/s")
+    return video_bitrate
 
 SUPPORTED_VIDEO_FORMATS = ['MP4', 'AVI', 'MOV', 'MKV']
+
+# Маппинг стандартных метаданных в MP4 теги
+MP4_TAG_MAPPING = {
+    'make': '\xa9mak',
+    'model': '\xa9mod',
+    'software': '\xa9swr',
+    'artist': '\xa9ART',
+    'comment': '\xa9cmt',
+    'encoder': '\xa9enc',
+    'copyright': 'cprt',
+    'album': '\xa9alb',
+    'title': '\xa9nam',
+    'description': 'desc',
+    'composer': '\xa9wrt',
+    'date': '\xa9day',
+    'keywords': 'keyw',
+    'handler_name': 'hndl'
+}
+
+# Атомы, специфичные для устройства
+MP4_DEVICE_ATOMS = {
+    'iPhone': {'©too': 'Apple Camera', '©gen': 'Original'},
+    'CapCut': {'©too': 'CapCut 9.9.0', '©gen': 'CapCut Export'},
+    'Android': {'©too': 'Samsung Camera', '©gen': 'Original'}
+}
+
+# Ключи QuickTime, под которыми FFmpeg записывает теги устройства
+MP4_FFMPEG_KEYS = {
+    'make': 'com.apple.quicktime.make',
+    'model': 'com.apple.quicktime.model',
+    'software': 'com.apple.quicktime.software',
+    'location': 'com.apple.quicktime.location.ISO6709',
+    'creation_time': 'com.apple.quicktime.creationdate'
+}
+FFMPEG_ATOM_KEYS = {'©too': 'encoding_tool', '©gen': 'genre'}
+
+# Кодеки, которые контейнер принимает без перекодирования (-c copy)
+CONTAINER_CODECS = {
+    'MP4': {
+        'video': {'h264', 'hevc', 'mpeg4', 'av1', 'vp9'},
+        'audio': {'aac', 'mp3', 'ac3', 'eac3', 'alac', 'opus', 'flac'},
+        'subtitle': {'mov_text'}
+    },
+    'MOV': {
+        'video': {'h264', 'hevc', 'mpeg4', 'prores', 'mjpeg'},
+        'audio': {'aac', 'mp3', 'ac3', 'eac3', 'alac', 'pcm_s16le', 'pcm_s24le'},
+        'subtitle': {'mov_text'}
+    },
+    'MKV': {
+        'video': {'h264', 'hevc', 'mpeg4', 'mpeg2video', 'vp8', 'vp9', 'av1'},
+        'audio': {'aac', 'mp3', 'ac3', 'eac3', 'opus', 'vorbis', 'flac', 'pcm_s16le'},
+        'subtitle': {'subrip', 'ass', 'ssa', 'webvtt', 'hdmv_pgs_subtitle', 'dvd_subtitle'}
+    },
+    'AVI': {
+        'video': {'mpeg4', 'msmpeg4v3', 'mjpeg'},
+        'audio': {'mp3', 'ac3', 'pcm_s16le'},
+        'subtitle': set()
+    }
+}
+
+# Кодировщики для потоков, которые не подходят целевому контейнеру
+DEFAULT_ENCODERS = {
+    'MP4': {'video': 'libx264', 'audio': 'aac', 'subtitle': 'mov_text'},
+    'MOV': {'video': 'libx264', 'audio': 'aac', 'subtitle': 'mov_text'},
+    'MKV': {'video': 'libx264', 'audio': 'aac', 'subtitle': 'srt'},
+    'AVI': {'video': 'mpeg4', 'audio': 'libmp3lame', 'subtitle': None}
+}
+
+TEXT_SUBTITLE_CODECS = {'subrip', 'ass', 'ssa', 'webvtt', 'mov_text', 'text'}
+
+# Во сколько раз перекодированное видео больше исходного при том же качестве (MPEG-4 Part 2 хуже H.264)
+ENCODER_SIZE_FACTORS = {'libx264': 1.0, 'mpeg4': 2.5}
 DEVICE_METADATA = {
     'iPhone': {
         'make': 'Apple',
@@ -116,6 +333,327 @@ DEVICE_METADATA = {
     }
 }
 
+def detect_container(info: MediaInfo, file_name: str) -> str:
+    """Detect the source container (one of SUPPORTED_VIDEO_FORMATS)."""
+    format_name = info.format_name
+    if 'matroska' in format_name:
+        return 'MKV'
+    if 'avi' in format_name:
+        return 'AVI'
+    if 'mp4' in format_name or 'mov' in format_name:
+        # MP4 и MOV определяются одним демультиплексором, различаем по бренду
+        if info.major_brand == 'qt':
+            return 'MOV'
+        if info.major_brand:
+            return 'MP4'
+    return Path(file_name).suffix.lstrip('.').upper()
+
+def apply_mp4_metadata(path: str, metadata: dict, metadata_type: str) -> None:
+    """Write device metadata atoms into an MP4/MOV file with mutagen."""
+    video = MP4(path)
+    
+    # Добавляем все доступные метаданные
+    for key, mp4_key in MP4_TAG_MAPPING.items():
+        if key in metadata:
+            video[mp4_key] = metadata[key]
+    
+    # Добавляем специфичные для устройства метаданные
+    for atom, value in MP4_DEVICE_ATOMS.get(metadata_type, {}).items():
+        video[atom] = value
+    
+    video.save()
+
+async def rewrite_metadata(source_path, target_path, container, metadata, metadata_type, owner=None):
+    """Apply metadata without touching the media streams; returns the path of the result."""
+    if container in ['MP4', 'MOV']:
+        # mutagen правит только атом moov, но на месте: правим копию, ожидающий исходник
+        # нужен для следующих конвертаций и повторного анализа
+        await asyncio.to_thread(shutil.copyfile, source_path, target_path)
+        await asyncio.to_thread(apply_mp4_metadata, target_path, metadata, metadata_type)
+        return target_path
+    await run_ffmpeg(source_path, target_path, metadata, owner=owner,
+                     codec_args=['-map', '0', '-c', 'copy', '-map_metadata', '0'])
+    return target_path
+
+def build_mp4_metadata(metadata: dict, metadata_type: str) -> dict:
+    """Map preset tags to keys FFmpeg writes with -movflags use_metadata_tags."""
+    tags = {}
+    for key, value in metadata.items():
+        tags[MP4_FFMPEG_KEYS.get(key, key)] = value
+    if 'creation_time' in metadata:
+        # creation_time дополнительно заполняет время создания в mvhd
+        tags['creation_time'] = metadata['creation_time']
+    for atom, value in MP4_DEVICE_ATOMS.get(metadata_type, {}).items():
+        tags[FFMPEG_ATOM_KEYS[atom]] = value
+    return tags
+
+async def encode_segments(source_path, work_dir, info, video_args, job, reporter=None, two_pass=False):
+    """Encode the video stream as parallel segments; returns the concat list path."""
+    # Части короче GOP не получатся: резать можно только по ключевым кадрам
+    segment_time = max(info.duration / SEGMENT_COUNT, info.keyframe_interval or 0)
+    
+    # Режем только видеодорожку по ключевым кадрам, без перекодирования
+    await run_ffmpeg(source_path, os.path.join(work_dir, 'segment_%03d.mkv'), job=job, codec_args=[
+        '-map', f"0:{info.video.index}", '-c', 'copy', '-f', 'segment',
+        '-segment_time', f'{segment_time:.3f}', '-reset_timestamps', '1'
+    ])
+    segments = sorted(name for name in os.listdir(work_dir) if name.startswith('segment_'))
+    logger.info(f"Encoding {len(segments)} video segments in parallel")
+    
+    limiter = asyncio.Semaphore(SEGMENT_COUNT)
+    async def encode(index, segment):
+        segment_path = os.path.join(work_dir, segment)
+        pass_args = []
+        async with limiter:
+            if two_pass:
+                passlog = os.path.join(work_dir, f'passlog_{index:03d}')
+                await run_ffmpeg(segment_path, '-', job=job, codec_args=[
+                    '-map', '0:v:0', *video_args, '-pass:v', '1', '-passlogfile:v', passlog, '-f', 'null'
+                ], progress=reporter.track(('pass1', index)) if reporter else None)
+                pass_args = ['-pass:v', '2', '-passlogfile:v', passlog]
+            await run_ffmpeg(segment_path, os.path.join(work_dir, f'encoded_{index:03d}.mkv'),
+                             job=job, codec_args=['-map', '0:v:0', *video_args, *pass_args],
+                             progress=reporter.track(index) if reporter else None)
+    
+    tasks = [asyncio.ensure_future(encode(index, segment)) for index, segment in enumerate(segments)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # Ошибка в одной части останавливает остальные процессы
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    
+    # Пути в списке относительные: concat ищет файлы рядом со списком
+    list_path = os.path.join(work_dir, 'segments.txt')
+    with open(list_path, 'w', encoding='utf-8') as f:
+        for index in range(len(segments)):
+            f.write(f"file 'encoded_{index:03d}.mkv'\n")
+    return list_path
+
+async def mux_video(inputs, target_path, codec_args, target_format, metadata, metadata_type, owner=None, job=None,
+                    progress=None):
+    """Write the target file, adding metadata and faststart for MP4/MOV."""
+    if target_format not in ['MP4', 'MOV']:
+        await run_ffmpeg(inputs, target_path, metadata, owner=owner, codec_args=codec_args, job=job,
+                         progress=progress)
+        return
+    
+    # Теги пишутся тем же проходом FFmpeg, moov переносится в начало файла
+    movflags = '+use_metadata_tags+faststart' if metadata else '+faststart'
+    try:
+        await run_ffmpeg(inputs, target_path, build_mp4_metadata(metadata, metadata_type),
+                         owner=owner, codec_args=codec_args + ['-movflags', movflags], job=job,
+                         progress=progress)
+    except FFmpegError as e:
+        if 'use_metadata_tags' not in str(e):
+            raise
+        # Старые сборки FFmpeg не знают use_metadata_tags: атомы дописывает mutagen
+        logger.warning("FFmpeg does not support use_metadata_tags, falling back to mutagen")
+        await run_ffmpeg(inputs, target_path, metadata, owner=owner,
+                         codec_args=codec_args + ['-movflags', '+faststart'], job=job,
+                         progress=progress)
+        try:
+            await asyncio.to_thread(apply_mp4_metadata, target_path, metadata, metadata_type)
+        except Exception as e:
+            logger.error(f"Error adding MP4 metadata: {str(e)}", exc_info=True)
+
+async def transcode_video(source_path, target_path, info, target_format, metadata, metadata_type, owner=None,
+                          reporter=None, video_bitrate=None, preset=None):
+    """Convert the source into the target container.
+
+    Long videos whose video stream needs re-encoding are split at keyframes and
+    encoded in parallel segments; otherwise a single FFmpeg pass is used.
+    With video_bitrate the video is re-encoded at that average bitrate (two
+    passes if VIDEO_TWO_PASS is set). Re-encoded streams use the encoder preset.
+    Progress goes to the optional reporter.
+    """
+    target_format = target_format.upper()
+    work_dir = os.path.dirname(target_path)
+    preset = preset or VIDEO_PRESETS[VIDEO_PRESET]
+    
+    # Потоки, которые уже подходят контейнеру, копируются без перекодирования
+    codec_args, copied_all = build_codec_args(info, target_format, video_bitrate=video_bitrate, preset=preset)
+    if copied_all:
+        logger.info("All streams fit the target container, remuxing with stream copy")
+    else:
+        logger.info("Running FFmpeg conversion")
+    
+    video_stream = info.video
+    encode_video = video_stream is not None and (
+        video_bitrate is not None or video_stream.codec_name not in CONTAINER_CODECS[target_format]['video'])
+    video_args = encoder_args('video', DEFAULT_ENCODERS[target_format]['video'], 'v', preset, video_bitrate)
+    two_pass = encode_video and video_bitrate is not None and VIDEO_TWO_PASS
+    if two_pass and reporter:
+        # Прогресс считается по обоим проходам
+        reporter.duration *= 2
+    duration = info.duration
+    
+    # Все процессы одной конвертации занимают один слот FFmpeg и отменяются вместе
+    async with ffmpeg_runner.ffmpeg_job(owner) as job:
+        if (not encode_video or not SEGMENT_MIN_DURATION or SEGMENT_COUNT < 2
+                or duration < SEGMENT_MIN_DURATION):
+            pass_args = []
+            if two_pass:
+                passlog = os.path.join(work_dir, 'passlog')
+                await run_ffmpeg(source_path, '-', job=job, codec_args=[
+                    '-map', f"0:{video_stream.index}", *video_args,
+                    '-pass:v', '1', '-passlogfile:v', passlog, '-f', 'null'
+                ], progress=reporter.track('pass1') if reporter else None)
+                pass_args = ['-pass:v', '2', '-passlogfile:v', passlog]
+            await mux_video(source_path, target_path, codec_args + pass_args, target_format, metadata,
+                            metadata_type, job=job, progress=reporter.track(0) if reporter else None)
+            return
+        
+        logger.info(f"Video is {duration:.0f} s long, encoding it in segments")
+        list_path = await encode_segments(source_path, work_dir, info, video_args, job, reporter, two_pass)
+        # Аудио и субтитры берутся из исходника один раз, при сборке частей
+        mux_args, _ = build_codec_args(info, target_format, segmented=True, preset=preset)
+        await mux_video(['-f', 'concat', '-i', list_path, '-i', source_path], target_path,
+                        mux_args + ['-map_metadata', '1'], target_format, metadata, metadata_type, job=job)
+
+async def transcode_formats(source_path, outputs, info, metadata, metadata_type, owner=None, reporter=None,
+                            video_bitrates=None, preset=None):
+    """Convert the source into several containers with one FFmpeg run.
+
+    outputs maps target formats to output paths. The source is demuxed and
+    decoded once; every output gets its own codec arguments, tags and movflags.
+    """
+    preset = preset or VIDEO_PRESETS[VIDEO_PRESET]
+    video_bitrates = video_bitrates or {}
+    
+    for use_metadata_tags in (True, False):
+        args = ['-progress', 'pipe:1', '-nostats'] if reporter else []
+        args.extend(['-i', source_path])
+        for target_format, target_path in outputs.items():
+            codec_args, _ = build_codec_args(info, target_format, video_bitrate=video_bitrates.get(target_format),
+                                             preset=preset)
+            args.extend(codec_args)
+            tags = metadata
+            if target_format in ['MP4', 'MOV']:
+                if metadata and use_metadata_tags:
+                    args.extend(['-movflags', '+use_metadata_tags+faststart'])
+                    tags = build_mp4_metadata(metadata, metadata_type)
+                else:
+                    args.extend(['-movflags', '+faststart'])
+            for key, value in tags.items():
+                args.extend(['-metadata', f'{key}={value}'])
+            args.append(target_path)
+        
+        try:
+            await ffmpeg_runner.run_ffmpeg(args, owner=owner, on_stdout_line=reporter.track(0) if reporter else None)
+            break
+        except FFmpegError as e:
+            if not use_metadata_tags or 'use_metadata_tags' not in str(e):
+                raise
+            # Старые сборки FFmpeg не знают use_metadata_tags: атомы дописывает mutagen
+            logger.warning("FFmpeg does not support use_metadata_tags, falling back to mutagen")
+    
+    if metadata and not use_metadata_tags:
+        for target_format, target_path in outputs.items():
+            if target_format in ['MP4', 'MOV']:
+                try:
+                    await asyncio.to_thread(apply_mp4_metadata, target_path, metadata, metadata_type)
+                except Exception as e:
+                    logger.error(f"Error adding MP4 metadata: {str(e)}", exc_info=True)
+
+def check_output_size(output_size: int) -> None:
+    """Raise SizeLimitError if the result is too large to be sent."""
+    if output_size > UPLOAD_LIMIT_BYTES:
+        raise SizeLimitError(
+            f"Результат ({output_size / (1024 * 1024):.0f} МБ) больше лимита Telegram "
+            f"({UPLOAD_LIMIT_BYTES / (1024 * 1024):.0f} МБ)."
+        )
+
+def needs_seeking(data) -> bool:
+    """True for MP4/MOV data whose moov atom comes after the media data.
+
+    FFmpeg cannot read such a file from a pipe: the index is needed before
+    the first sample and is only found by seeking to the end.
+    """
+    offset = 0
+    while offset + 8 <= len(data):
+        size = int.from_bytes(data[offset:offset + 4], 'big')
+        box_type = bytes(data[offset + 4:offset + 8])
+        if box_type == b'moov':
+            return False
+        if box_type == b'mdat':
+            return True
+        if size == 1 and offset + 16 <= len(data):
+            size = int.from_bytes(data[offset + 8:offset + 16], 'big')
+        if size < 8:
+            break
+        offset += size
+    return False
+
+async def transcode_pipe(data, info, target_format, metadata, metadata_type, owner=None, preset=None) -> bytes:
+    """Convert in-memory data with FFmpeg reading stdin and writing stdout."""
+    target_format = target_format.upper()
+    codec_args, _ = build_codec_args(info, target_format, preset=preset)
+    args = ['-i', 'pipe:0', *codec_args]
+    tags = metadata
+    if target_format in ['MP4', 'MOV']:
+        # faststart требует перемотки, в поток пишется фрагментированный MP4
+        if metadata:
+            args.extend(['-movflags', f'{PIPE_MOVFLAGS}+use_metadata_tags'])
+            tags = build_mp4_metadata(metadata, metadata_type)
+        else:
+            args.extend(['-movflags', PIPE_MOVFLAGS])
+    for key, value in tags.items():
+        args.extend(['-metadata', f'{key}={value}'])
+    args.extend(['-f', PIPE_MUXERS[target_format], 'pipe:1'])
+    result = await ffmpeg_runner.run_ffmpeg(args, owner=owner, input_data=data)
+    return result.stdout
+
+async def convert_in_memory(upload, target_format, metadata, metadata_type, owner=None, preset=None):
+    """Convert a small in-memory upload without touching the filesystem.
+
+    Returns the converted bytes, or None when the upload has to go through
+    files: it is spooled or larger than PIPE_MAX_BYTES, the target container
+    cannot be streamed, the source needs seeking, only the metadata changes
+    (rewrite_metadata is cheaper than a remux), the result may exceed the
+    upload limit, or the pipe run fails.
+    """
+    if (not PIPE_MAX_BYTES or 'bytes' not in upload or upload['size'] > min(PIPE_MAX_BYTES, UPLOAD_LIMIT_BYTES)
+            or target_format.upper() not in PIPE_MUXERS):
+        return None
+    data = upload['bytes']
+    if needs_seeking(data):
+        logger.info("moov atom is at the end of the source, converting through files")
+        return None
+    
+    info = await probe_media(data, upload.get('file_unique_id'))
+    if info is None:
+        return None
+    if metadata and detect_container(info, upload.get('name') or '') == target_format.upper():
+        # Контейнер тот же: через файлы перепишутся только метаданные
+        return None
+    if estimate_output_size(info, target_format, preset) > UPLOAD_LIMIT_BYTES:
+        # Битрейт под лимит подбирается только при конвертации через файлы
+        return None
+    try:
+        output = await transcode_pipe(data, info, target_format, metadata, metadata_type, owner=owner, preset=preset)
+    except (FFmpegCancelled, FFmpegTimeout):
+        raise
+    except FFmpegError as e:
+        logger.warning(f"Pipe conversion failed, converting through files: {str(e)}")
+        return None
+    logger.info(f"Converted in memory, output size: {len(output)} bytes")
+    check_output_size(len(output))
+    return output or None
+
+def prepare_metadata(metadata_type: str) -> dict:
+    """Device metadata preset with the timestamps set to now."""
+    metadata = {}
+    if metadata_type and metadata_type in DEVICE_METADATA:
+        metadata = DEVICE_METADATA[metadata_type].copy()
+        # Обновляем временные метки текущим временем
+        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        metadata['creation_time'] = current_time
+        metadata['date'] = current_time
+    return metadata
+
 def get_user_settings(context: ContextTypes.DEFAULT_TYPE) -> dict:
     """Get user settings or create default ones."""
     if 'settings' not in context.user_data:
@@ -140,17 +678,17 @@ async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
         # Download video
         logger.info("Downloading video file")
-        video_file = await context.bot.get_file(video.file_id)
-        video_bytes = await video_file.download_as_bytearray()
+        upload = await download_upload(context.bot, video.file_id, getattr(video, 'file_name', None))
         
-        logger.info(f"Video downloaded successfully, size: {len(video_bytes)} bytes")
+        logger.info(f"Video downloaded successfully, size: {upload['size']} bytes")
         
-        # Store video info in context
-        context.user_data['current_video'] = {
-            'bytes': video_bytes,
+        # Store the video until the user picks a format
+        PENDING_UPLOADS.put(update.effective_user.id, 'video', {
+            **upload,
             'name': getattr(video, 'file_name', 'video'),
-            'mime_type': getattr(video, 'mime_type', 'video/mp4')
-        }
+            'mime_type': getattr(video, 'mime_type', 'video/mp4'),
+            'file_unique_id': video.file_unique_id
+        })
         
         # Ask user what they want to do
         keyboard = get_metadata_keyboard()
@@ -171,120 +709,95 @@ async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 async def convert_video(update: Update, context: ContextTypes.DEFAULT_TYPE, target_format: str, metadata_type: str = None) -> None:
     """Convert video to target format and optionally add metadata."""
     temp_dir = None
+    reporter = None
     try:
         logger.info(f"Starting video conversion to {target_format}")
-        if 'current_video' not in context.user_data:
-            await update.message.reply_text(
-                text=f"{IMAGES['error']} Пожалуйста, сначала отправьте видео."
-            )
+        user_id = update.effective_user.id
+        video_info = PENDING_UPLOADS.get(user_id, 'video')
+        if video_info is None:
+            if PENDING_UPLOADS.expired(user_id, 'video'):
+                text = f"{IMAGES['error']} {UPLOAD_EXPIRED_MESSAGE}"
+            else:
+                text = f"{IMAGES['error']} Пожалуйста, сначала отправьте видео."
+            await update.message.reply_text(text=text)
             return
             
-        video_info = context.user_data['current_video']
-        video_bytes = video_info['bytes']
         original_name = Path(video_info['name']).stem
         
-        logger.info(f"Creating temporary directory for video conversion")
-        temp_dir = tempfile.mkdtemp()
-        logger.info(f"Temporary directory created at: {temp_dir}")
-        
-        # Save original video
-        source_path = os.path.join(temp_dir, f"source{Path(video_info['name']).suffix}")
-        logger.info(f"Saving source video to: {source_path}")
-        with open(source_path, 'wb') as f:
-            f.write(video_bytes)
-        
-        if not os.path.exists(source_path):
-            raise FileNotFoundError(f"Source file was not created at {source_path}")
-            
-        # Prepare output path
-        target_path = os.path.join(temp_dir, f"output.{target_format.lower()}")
-        logger.info(f"Target path will be: {target_path}")
-        
-        # Check if video is valid
-        if not probe_video(source_path):
-            raise RuntimeError("Невозможно обработать видео файл. Проверьте, что файл не поврежден.")
-            
-        # Convert video
-        logger.info("Starting FFmpeg conversion")
-        
         # Get metadata settings
         settings = get_user_settings(context)
         metadata_type = metadata_type or settings.get('video_metadata')
+        preset_name = get_video_preset(settings)
+        preset = VIDEO_PRESETS[preset_name]
         
         # Prepare metadata
-        metadata = {}
-        if metadata_type and metadata_type in DEVICE_METADATA:
-            metadata = DEVICE_METADATA[metadata_type].copy()
-            # Обновляем временные метки текущим временем
-            current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            metadata['creation_time'] = current_time
-            metadata['date'] = current_time
+        metadata = prepare_metadata(metadata_type)
         
-        logger.info("Running FFmpeg conversion")
-        run_ffmpeg(source_path, target_path, metadata)
-        
-        if not os.path.exists(target_path):
-            raise FileNotFoundError(f"Converted file was not created at {target_path}")
-        
-        logger.info("Conversion completed successfully")
-        
-        # Additional metadata for MP4/MOV
-        if target_format.upper() in ['MP4', 'MOV'] and metadata_type:
-            try:
-                logger.info("Adding additional metadata for MP4/MOV")
-                video = MP4(target_path)
+        caption = f"Вот ваше видео в формате {target_format.upper()}! ✨"
+        cache_key = ResultCache.make_key(video_info.get('file_unique_id'), target_format, metadata_type,
+                                         preset=preset_name)
+        if not await reply_cached(update.message, cache_key, caption):
+            # Короткие ролики из памяти идут через stdin/stdout FFmpeg, без временных файлов
+            output = await convert_in_memory(video_info, target_format, metadata, metadata_type,
+                                             owner=update.effective_user.id, preset=preset)
+            if output is None:
+                logger.info(f"Creating work directory for video conversion")
+                # Место под копию исходника, результат и промежуточные части
+                temp_dir = SPOOL.acquire(video_info.get('spool_dir'), reserve=video_info['size'] * 3)
+                logger.info(f"Work directory created at: {temp_dir}")
                 
-                # Маппинг стандартных метаданных в MP4 теги
-                mp4_mapping = {
-                    'make': '\xa9mak',
-                    'model': '\xa9mod',
-                    'software': '\xa9swr',
-                    'artist': '\xa9ART',
-                    'comment': '\xa9cmt',
-                    'encoder': '\xa9enc',
-                    'copyright': 'cprt',
-                    'album': '\xa9alb',
-                    'title': '\xa9nam',
-                    'description': 'desc',
-                    'composer': '\xa9wrt',
-                    'date': '\xa9day',
-                    'keywords': 'keyw',
-                    'handler_name': 'hndl'
-                }
+                # Save original video (spooled uploads are read in place)
+                source_path = upload_to_path(video_info, os.path.join(temp_dir, f"source{Path(video_info['name']).suffix}"))
+                logger.info(f"Source video path: {source_path}")
                 
-                # Добавляем все доступные метаданные
-                for key, mp4_key in mp4_mapping.items():
-                    if key in metadata:
-                        video[mp4_key] = metadata[key]
+                if not os.path.exists(source_path):
+                    raise FileNotFoundError(f"Source file was not created at {source_path}")
                 
-                # Добавляем специфичные для устройства метаданные
-                if metadata_type == 'iPhone':
-                    video['©too'] = 'Apple Camera'
-                    video['©gen'] = 'Original'
-                elif metadata_type == 'CapCut':
-                    video['©too'] = 'CapCut 9.9.0'
-                    video['©gen'] = 'CapCut Export'
-                elif metadata_type == 'Android':
-                    video['©too'] = 'Samsung Camera'
-                    video['©gen'] = 'Original'
+                # Prepare output path
+                target_path = os.path.join(temp_dir, f"output.{target_format.lower()}")
+                logger.info(f"Target path will be: {target_path}")
                 
-                video.save()
-                logger.info("Additional metadata added successfully")
-            except Exception as e:
-                logger.error(f"Error adding MP4 metadata: {str(e)}", exc_info=True)
-        
-        # Read converted file
-        logger.info("Reading converted file")
-        with open(target_path, 'rb') as f:
-            output_bytes = f.read()
-        
-        # Send converted file
-        logger.info("Sending converted file")
-        await update.message.reply_document(
-            document=output_bytes,
-            filename=f"{original_name}.{target_format.lower()}",
-            caption=f"Вот ваше видео в формате {target_format.upper()}! ✨"
-        )
+                # Check if video is valid
+                # Анализ кэшируется по file_unique_id: повторная конвертация не запускает FFprobe
+                info = await probe_media(source_path, video_info.get('file_unique_id'))
+                if info is None:
+                    raise RuntimeError("Невозможно обработать видео файл. Проверьте, что файл не поврежден.")
+                
+                # Результат больше лимита Bot API не отправится: битрейт подбирается до кодирования
+                video_bitrate = upload_video_bitrate(info, os.path.getsize(source_path), target_format, preset)
+                
+                # Convert video
+                logger.info("Starting FFmpeg conversion")
+                
+                source_format = detect_container(info, video_info['name'])
+                if metadata and source_format == target_format.upper() and video_bitrate is None:
+                    # Контейнер не меняется: переписываем только метаданные, потоки не трогаем
+                    logger.info(f"Source is already {source_format}, rewriting metadata only")
+                    target_path = await rewrite_metadata(source_path, target_path, source_format, metadata,
+                                                         metadata_type, owner=update.effective_user.id)
+                else:
+                    # Статус с процентом и оставшимся временем вместо тишины до результата
+                    if info.duration > 0:
+                        status = await update.message.reply_text(text="⏳ Конвертация видео...")
+                        reporter = ProgressReporter(status, info.duration, f"⏳ Конвертация в {target_format.upper()}")
+                    await transcode_video(source_path, target_path, info, target_format, metadata,
+                                          metadata_type, owner=update.effective_user.id, reporter=reporter,
+                                          video_bitrate=video_bitrate, preset=preset)
+                
+                if not os.path.exists(target_path):
+                    raise FileNotFoundError(f"Converted file was not created at {target_path}")
+                
+                check_output_size(os.path.getsize(target_path))
+                
+                logger.info("Conversion completed successfully")
+                
+                # The result is uploaded straight from the work directory
+                output = Path(target_path)
+            
+            # Send converted file
+            logger.info("Sending converted file")
+            await reply_result(update.message, cache_key, output, f"{original_name}.{target_format.lower()}",
+                               caption)
         
         # Send success message with detailed metadata info
         metadata_info = f"\n📝 Добавлены метаданные: {metadata_type}" if metadata_type else ""
@@ -302,14 +815,25 @@ async def convert_video(update: Update, context: ContextTypes.DEFAULT_TYPE, targ
                 settings_info += f"\n• Устройство: {metadata['make']} {metadata['model']}"
                 settings_info += f"\n• Версия Android: {metadata['os_version']}"
                 settings_info += f"\n• Кодировщик: {metadata['encoder']}"
+        settings_info += f"\n• Пресет: {VIDEO_PRESET_LABELS[preset_name]}"
         
         await update.message.reply_text(
             text=f"{IMAGES['success']} Конвертация завершена успешно!{metadata_info}{settings_info}"
         )
         
         # Clear stored video
-        del context.user_data['current_video']
+        PENDING_UPLOADS.discard(user_id, 'video')
         
+    except SizeLimitError as e:
+        logger.info(f"Video does not fit the upload limit: {str(e)}")
+        await update.message.reply_text(
+            text=f"{IMAGES['error']} {str(e)}"
+        )
+    except FFmpegCancelled:
+        logger.info("Video conversion cancelled by user")
+        await update.message.reply_text(
+            text=f"{IMAGES['error']} Конвертация видео отменена."
+        )
     except Exception as e:
         logger.error(f"Error converting video: {str(e)}", exc_info=True)
         error_message = str(e)
@@ -319,14 +843,120 @@ async def convert_video(update: Update, context: ContextTypes.DEFAULT_TYPE, targ
             text=f"{IMAGES['error']} Произошла ошибка при конвертации видео. Подробности: {error_message}"
         )
     finally:
-        # Cleanup temporary directory
-        if temp_dir and os.path.exists(temp_dir):
-            try:
-                for file in os.listdir(temp_dir):
-                    file_path = os.path.join(temp_dir, file)
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                os.rmdir(temp_dir)
-                logger.info("Temporary directory cleaned up successfully")
-            except Exception as e:
-                logger.error(f"Error cleaning up temporary directory: {str(e)}", exc_info=True) 
\ No newline at end of file
+        if reporter:
+            await reporter.close()
+        
+        # Cleanup work directory
+        SPOOL.release(temp_dir)
+
+async def convert_video_formats(update: Update, context: ContextTypes.DEFAULT_TYPE, target_formats: list,
+                                metadata_type: str = None) -> None:
+    """Convert video to several formats in one FFmpeg run and send them as a media group."""
+    temp_dir = None
+    reporter = None
+    try:
+        logger.info(f"Starting video conversion to {', '.join(target_formats)}")
+        user_id = update.effective_user.id
+        video_info = PENDING_UPLOADS.get(user_id, 'video')
+        if video_info is None:
+            if PENDING_UPLOADS.expired(user_id, 'video'):
+                text = f"{IMAGES['error']} {UPLOAD_EXPIRED_MESSAGE}"
+            else:
+                text = f"{IMAGES['error']} Пожалуйста, сначала отправьте видео."
+            await update.message.reply_text(text=text)
+            return
+        
+        original_name = Path(video_info['name']).stem
+        target_formats = [target_format.upper() for target_format in target_formats]
+        
+        settings = get_user_settings(context)
+        metadata_type = metadata_type or settings.get('video_metadata')
+        if not metadata_type:
+            # Без новых метаданных в исходный контейнер перекодировать незачем
+            source_format = (Path(video_info['name']).suffix.lstrip('.').upper()
+                             or VIDEO_MIME_FORMATS.get(video_info.get('mime_type')))
+            target_formats = [target_format for target_format in target_formats if target_format != source_format]
+        preset_name = get_video_preset(settings)
+        preset = VIDEO_PRESETS[preset_name]
+        metadata = prepare_metadata(metadata_type)
+        
+        # Уже отправленные результаты берем из кэша, конвертируем только остальные
+        items = []
+        for target_format in target_formats:
+            cache_key = ResultCache.make_key(video_info.get('file_unique_id'), target_format, metadata_type,
+                                             preset=preset_name)
+            items.append([cache_key, await lookup_result(cache_key), f"{original_name}.{target_format.lower()}"])
+        missing = [target_formats[index] for index, item in enumerate(items) if item[1] is None]
+        
+        if missing:
+            temp_dir = SPOOL.acquire(video_info.get('spool_dir'), reserve=video_info['size'] * (len(missing) + 1))
+            source_path = upload_to_path(video_info, os.path.join(temp_dir, f"source{Path(video_info['name']).suffix}"))
+            info = await probe_media(source_path, video_info.get('file_unique_id'))
+            if info is None:
+                raise RuntimeError("Невозможно обработать видео файл. Проверьте, что файл не поврежден.")
+            
+            # Битрейт под лимит Bot API подбирается до запуска FFmpeg
+            video_bitrates = {}
+            for target_format in missing:
+                video_bitrate = upload_video_bitrate(info, os.path.getsize(source_path), target_format, preset)
+                if video_bitrate:
+                    video_bitrates[target_format] = video_bitrate
+            
+            outputs = {
+                target_format: os.path.join(temp_dir, f"output.{target_format.lower()}")
+                for target_format in missing
+            }
+            if info.duration > 0:
+                status = await update.message.reply_text(text="⏳ Конвертация видео...")
+                reporter = ProgressReporter(status, info.duration, f"⏳ Конвертация в {', '.join(missing)}")
+            await transcode_formats(source_path, outputs, info, metadata, metadata_type, owner=user_id,
+                                    reporter=reporter, video_bitrates=video_bitrates, preset=preset)
+            
+            for item, target_format in zip(items, target_formats):
+                if target_format not in outputs:
+                    continue
+                target_path = outputs[target_format]
+                if not os.path.exists(target_path):
+                    raise FileNotFoundError(f"Converted file was not created at {target_path}")
+                if os.path.getsize(target_path) > UPLOAD_LIMIT_BYTES:
+                    raise SizeLimitError(
+                        f"Результат в {target_format} больше лимита Telegram "
+                        f"({UPLOAD_LIMIT_BYTES / (1024 * 1024):.0f} МБ)."
+                    )
+                item[1] = Path(target_path)
+        
+        formats_text = ', '.join(target_formats)
+        await reply_document_group(
+            update.message, [tuple(item) for item in items],
+            caption=f"Вот ваше видео в форматах {formats_text}! ✨"
+        )
+        
+        metadata_info = f"\n📝 Добавлены метаданные: {metadata_type}" if metadata_type else ""
+        await update.message.reply_text(
+            text=f"{IMAGES['success']} Конвертация завершена успешно!\n"
+                 f"🎥 Форматы: {formats_text}{metadata_info}\n"
+                 f"⚙️ Пресет: {VIDEO_PRESET_LABELS[preset_name]}"
+        )
+        
+        # Clear stored video
+        PENDING_UPLOADS.discard(user_id, 'video')
+        
+    except SizeLimitError as e:
+        logger.info(f"Video does not fit the upload limit: {str(e)}")
+        await update.message.reply_text(
+            text=f"{IMAGES['error']} {str(e)}"
+        )
+    except FFmpegCancelled:
+        logger.info("Video conversion cancelled by user")
+        await update.message.reply_text(
+            text=f"{IMAGES['error']} Конвертация видео отменена."
+        )
+    except Exception as e:
+        logger.error(f"Error converting video to several formats: {str(e)}", exc_info=True)
+        await update.message.reply_text(
+            text=f"{IMAGES['error']} Произошла ошибка при конвертации видео. Подробности: {str(e)}"
+        )
+    finally:
+        if reporter:
+            await reporter.close()
+        SPOOL.release(temp_dir)
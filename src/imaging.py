@@ -0,0 +1,238 @@
+"""
+Image decoding and encoding, run inside worker processes.
+"""
+import io
+import piexif
+from PIL import Image
+
+# Convert format name to proper format
+FORMAT_MAPPING = {
+    'JPG': 'JPEG',
+    'PNG': 'PNG',
+    'WEBP': 'WEBP'
+}
+
+FIT_MIN_QUALITY = 10  # Ниже JPEG и WEBP рассыпаются на блоки
+FIT_SCALE_QUALITY = 75  # Качество, с которым подбирается масштаб
+FIT_SCALES = [step / 20 for step in range(2, 20)]  # 10% ... 95%
+
+class ImageSizeError(ValueError):
+    """The image cannot be made small enough."""
+
+def read_source(source) -> bytes:
+    """Get the raw bytes of an image given as bytes or a file path."""
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source)
+    with open(source, 'rb') as f:
+        return f.read()
+
+def is_jpeg(data: bytes) -> bool:
+    """Check the JPEG SOI marker."""
+    return data[:2] == b'\xff\xd8'
+
+def merge_exif(source_exif: bytes, exif: bytes = None) -> bytes:
+    """Lay the tags of exif over the source EXIF (an EXIF block or a whole JPEG).
+
+    Falls back to exif alone if the source block cannot be re-serialized.
+    """
+    if not source_exif or not exif:
+        return exif or source_exif
+    try:
+        merged = piexif.load(source_exif)
+        for ifd, tags in piexif.load(exif).items():
+            if isinstance(tags, dict):
+                merged[ifd].update(tags)
+        return piexif.dump(merged)
+    except Exception:
+        # piexif не может пересобрать некоторые нестандартные теги
+        return exif
+
+def retag_jpeg(source, exif: bytes, keep_exif: bool) -> bytes:
+    """Replace the EXIF block of a JPEG without decoding the image.
+
+    Returns None if the source is not a JPEG. The compressed data is copied
+    as is, so there is no generation loss and no pixel work.
+    """
+    data = read_source(source)
+    if not is_jpeg(data):
+        return None
+    if keep_exif:
+        if not exif:
+            return data
+        exif = merge_exif(data, exif)
+    output = io.BytesIO()
+    if exif:
+        piexif.insert(exif, data, output)
+    else:
+        piexif.remove(data, output)
+    return output.getvalue()
+
+def open_image(source, max_side: int = None) -> Image.Image:
+    """Decode an image from bytes or a file path.
+
+    With max_side the longer side is reduced to at most max_side pixels. JPEGs
+    are then decoded at 1/2, 1/4 or 1/8 scale right in the DCT domain
+    (Image.draft), so the full-size bitmap never exists; only the remaining
+    factor of less than two is resampled.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    img = Image.open(source)
+    if not max_side or max(img.size) <= max_side:
+        img.load()
+        return img
+    
+    ratio = max_side / max(img.size)
+    size = (max(1, round(img.width * ratio)), max(1, round(img.height * ratio)))
+    if img.format == 'JPEG':
+        img.draft(img.mode, size)
+    img.load()
+    if img.size != size:
+        img = img.resize(size, Image.BILINEAR)
+    return img
+
+def save_image(img: Image.Image, target_format: str, quality: int, optimize: bool, exif: bytes = None,
+               keep_exif: bool = False) -> bytes:
+    """Encode a decoded image in the target format.
+
+    exif is written into the result; with keep_exif it is merged over the
+    EXIF of the source image.
+    """
+    save_format = FORMAT_MAPPING.get(target_format.upper())
+    if not save_format:
+        raise ValueError(f"Неподдерживаемый формат: {target_format}")
+    
+    if keep_exif:
+        exif = merge_exif(img.info.get('exif'), exif)
+    
+    # Save with appropriate settings for each format
+    save_kwargs = {}
+    
+    # Add metadata if requested
+    if exif:
+        save_kwargs['exif'] = exif
+    
+    if save_format == 'JPEG':
+        # Remove alpha channel if present
+        if img.mode in ('RGBA', 'LA'):
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.split()[-1])
+            img = background
+        save_kwargs.update({
+            'quality': quality,
+            'optimize': optimize
+        })
+            
+    elif save_format == 'PNG':
+        save_kwargs.update({
+            'optimize': optimize
+        })
+        
+    elif save_format == 'WEBP':
+        save_kwargs.update({
+            'quality': quality,
+            'method': 6 if optimize else 4
+        })
+    
+    # Save the image
+    output = io.BytesIO()
+    img.save(output, format=save_format, **save_kwargs)
+    return output.getvalue()
+
+def encode_image(source, target_format: str, quality: int, optimize: bool, exif: bytes = None,
+                 keep_exif: bool = False, max_side: int = None) -> bytes:
+    """Decode the source image and encode it in the target format."""
+    if not FORMAT_MAPPING.get(target_format.upper()):
+        raise ValueError(f"Неподдерживаемый формат: {target_format}")
+    return save_image(open_image(source, max_side), target_format, quality, optimize, exif, keep_exif)
+
+def _search(candidates: list, encode, max_bytes: int):
+    """Find the largest candidate whose encoding fits into max_bytes.
+
+    The output size must grow with the candidate. The largest candidate is
+    tried first (it often fits already), then the range is bisected. Pillow
+    holds the GIL while encoding into memory, so the trial encodes run one
+    after another. Returns ((candidate, data) or None, encodes).
+    """
+    low, high = 0, len(candidates) - 1
+    index = high
+    best = None
+    encodes = 0
+    while low <= high:
+        data = encode(candidates[index])
+        encodes += 1
+        if len(data) > max_bytes:
+            high = index - 1
+        else:
+            best = (candidates[index], data)
+            low = index + 1
+        index = (low + high) // 2
+    return best, encodes
+
+def fit_decoded(img: Image.Image, target_format: str, max_bytes: int, quality: int, optimize: bool,
+                exif: bytes = None):
+    """Encode the image as well as possible within max_bytes.
+
+    The encoder quality is searched first (up to the requested quality); if
+    even FIT_MIN_QUALITY is too large, the image is scaled down. PNG has no
+    quality, only the scale is searched. Returns (data, quality, scale, encodes).
+    """
+    encodes = 0
+    scales = FIT_SCALES
+    if FORMAT_MAPPING[target_format.upper()] == 'PNG':
+        scales = FIT_SCALES + [1.0]
+    else:
+        found, count = _search(
+            list(range(FIT_MIN_QUALITY, max(quality, FIT_MIN_QUALITY) + 1)),
+            lambda candidate: save_image(img, target_format, candidate, optimize, exif),
+            max_bytes
+        )
+        encodes += count
+        if found:
+            return found[1], found[0], 1.0, encodes
+        quality = min(quality, FIT_SCALE_QUALITY)
+    
+    def encode_scaled(scale):
+        if scale == 1.0:
+            return save_image(img, target_format, quality, optimize, exif)
+        size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        return save_image(img.resize(size, Image.LANCZOS), target_format, quality, optimize, exif)
+    
+    found, count = _search(scales, encode_scaled, max_bytes)
+    encodes += count
+    if not found:
+        raise ImageSizeError(
+            f"Не удалось уместить изображение в {max_bytes // 1024} КБ даже при уменьшении до {FIT_SCALES[0]:.0%}."
+        )
+    return found[1], quality, found[0], encodes
+
+def fit_image(source, target_format: str, max_bytes: int, quality: int, optimize: bool, exif: bytes = None,
+              keep_exif: bool = False, max_side: int = None):
+    """Decode the source and encode it within max_bytes; see fit_decoded."""
+    if not FORMAT_MAPPING.get(target_format.upper()):
+        raise ValueError(f"Неподдерживаемый формат: {target_format}")
+    img = open_image(source, max_side)
+    if keep_exif:
+        exif = merge_exif(img.info.get('exif'), exif)
+    return fit_decoded(img, target_format, max_bytes, quality, optimize, exif)
+
+def decode_image(source, max_side: int = None) -> Image.Image:
+    """Decode the source once for a multi-format conversion.
+
+    The result is sent back to the caller as pixels, mode, palette and info
+    (EXIF included), so every format can be encoded from it by
+    encode_decoded in its own worker process without decoding again.
+    """
+    # copy() дает обычный Image: у Image из плагина (JpegImageFile и т.п.) после pickle нет файла
+    return open_image(source, max_side).copy()
+
+def encode_decoded(img: Image.Image, target_format: str, quality: int, optimize: bool, exif: bytes = None,
+                   keep_exif: bool = False, max_bytes: int = None) -> bytes:
+    """Encode an image from decode_image in one format; with max_bytes fit it into the limit."""
+    if not FORMAT_MAPPING.get(target_format.upper()):
+        raise ValueError(f"Неподдерживаемый формат: {target_format}")
+    if keep_exif:
+        exif = merge_exif(img.info.get('exif'), exif)
+    if max_bytes:
+        return fit_decoded(img, target_format, max_bytes, quality, optimize, exif)[0]
+    return save_image(img, target_format, quality, optimize, exif)
@@ -13,6 +13,7 @@ def get_format_keyboard() -> ReplyKeyboardMarkup:
     """Get format selection keyboard."""
     keyboard = [
         ['JPG', 'PNG', 'WEBP'],
+        ['Во все форматы'],
         ['Отмена']
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
@@ -20,10 +21,18 @@ def get_format_keyboard() -> ReplyKeyboardMarkup:
 def get_settings_keyboard() -> ReplyKeyboardMarkup:
     """Get settings keyboard."""
     keyboard = [
-        ['Качество изображения'],
+        ['Качество изображения', 'Разрешение'],
         ['Формат по умолчанию'],
         ['EXIF данные', 'Оптимизация'],
-        ['Метаданные видео'],
+        ['Метаданные видео', 'Пресет видео'],
+        ['Назад']
+    ]
+    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+
+def get_video_preset_keyboard() -> ReplyKeyboardMarkup:
+    """Get video encoder preset keyboard."""
+    keyboard = [
+        ['Быстрый', 'Сбалансированный', 'Компактный'],
         ['Назад']
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
@@ -32,6 +41,17 @@ def get_quality_keyboard() -> ReplyKeyboardMarkup:
     """Get quality selection keyboard."""
     keyboard = [
         ['Высокое', 'Среднее', 'Низкое'],
+        ['До 500 КБ', 'До 1 МБ', 'До 2 МБ'],
+        ['Без ограничения размера'],
+        ['Назад']
+    ]
+    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+
+def get_resize_keyboard() -> ReplyKeyboardMarkup:
+    """Get image resize preset keyboard."""
+    keyboard = [
+        ['1280 px', '1920 px', '4096 px'],
+        ['Исходное разрешение'],
         ['Назад']
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
@@ -62,7 +82,8 @@ def get_doc_format_keyboard(current_format: str) -> ReplyKeyboardMarkup:
 def get_video_format_keyboard() -> ReplyKeyboardMarkup:
     """Get video format selection keyboard."""
     keyboard = [
-        ['MP4', 'AVI', 'MOV'],
+        ['MP4', 'AVI', 'MOV', 'MKV'],
+        ['Во все форматы'],
         ['Конвертировать без метаданных'],
         ['Отмена']
     ]
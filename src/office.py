@@ -0,0 +1,238 @@
+"""
+Headless LibreOffice workers for DOC/DOCX → PDF conversion.
+"""
+import os
+import time
+import shutil
+import asyncio
+import logging
+import tempfile
+import subprocess
+from pathlib import Path
+from typing import List, Optional
+from src.config import OFFICE_BIN, OFFICE_WORKERS, OFFICE_PORT, OFFICE_TIMEOUT
+
+try:
+    import uno
+except ImportError:
+    # Мост UNO есть только у Python из поставки LibreOffice (пакет python3-uno)
+    uno = None
+
+logger = logging.getLogger(__name__)
+
+STARTUP_TIMEOUT = 60  # Секунд на запуск soffice и подключение по UNO
+CONNECT_INTERVAL = 0.5
+PDF_FILTER = 'writer_pdf_Export'
+
+class OfficeError(RuntimeError):
+    """LibreOffice failed to convert the document."""
+
+def _find_soffice() -> Optional[str]:
+    """Locate the LibreOffice executable."""
+    for name in (OFFICE_BIN, 'soffice', 'libreoffice'):
+        path = shutil.which(name)
+        if path:
+            return path
+    return None
+
+SOFFICE_EXE = _find_soffice()
+
+def _profile_url(name: str) -> str:
+    """User profile for one soffice process; parallel processes cannot share one."""
+    return Path(tempfile.gettempdir(), f"file-converter-office-{name}").as_uri()
+
+def _property(name: str, value):
+    """Build a com.sun.star.beans.PropertyValue."""
+    prop = uno.createUnoStruct('com.sun.star.beans.PropertyValue')
+    prop.Name = name
+    prop.Value = value
+    return prop
+
+class OfficeWorker:
+    """One long-lived headless soffice process with its own UNO connection.
+
+    The blocking UNO calls run in a thread; a worker handles one document at
+    a time.
+    """
+
+    def __init__(self, port: int):
+        self.port = port
+        self.process: Optional[subprocess.Popen] = None
+        self.desktop = None
+
+    @property
+    def alive(self) -> bool:
+        """Whether the soffice process is running and connected."""
+        return self.process is not None and self.process.poll() is None and self.desktop is not None
+
+    def start(self) -> None:
+        """Start soffice and connect to it (blocking)."""
+        self.stop()
+        logger.info(f"Starting LibreOffice worker on port {self.port}")
+        self.process = subprocess.Popen([
+            SOFFICE_EXE, '--headless', '--invisible', '--nologo', '--norestore', '--nodefault', '--nolockcheck',
+            f'-env:UserInstallation={_profile_url(self.port)}',
+            f'--accept=socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext'
+        ], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        # soffice принимает подключения не сразу после запуска
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while True:
+            try:
+                self.desktop = self._connect()
+                return
+            except Exception as e:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    self.stop()
+                    raise OfficeError(f"Не удалось запустить LibreOffice: {str(e)}")
+                time.sleep(CONNECT_INTERVAL)
+
+    def _connect(self):
+        """Resolve the Desktop service of the worker's soffice."""
+        local_context = uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext(
+            'com.sun.star.bridge.UnoUrlResolver', local_context
+        )
+        context = resolver.resolve(
+            f'uno:socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext'
+        )
+        return context.ServiceManager.createInstanceWithContext('com.sun.star.frame.Desktop', context)
+
+    def convert(self, source_path: str, target_path: str) -> None:
+        """Open the document hidden and export it to PDF (blocking)."""
+        document = self.desktop.loadComponentFromURL(
+            Path(source_path).absolute().as_uri(), '_blank', 0, (_property('Hidden', True),)
+        )
+        if document is None:
+            raise OfficeError("LibreOffice не смог открыть документ")
+        try:
+            document.storeToURL(Path(target_path).absolute().as_uri(), (_property('FilterName', PDF_FILTER),))
+        finally:
+            document.close(True)
+
+    def stop(self) -> None:
+        """Kill the soffice process."""
+        self.desktop = None
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+class OfficePool:
+    """Warm headless LibreOffice processes handing out conversions over UNO.
+
+    Workers are started on first use and then kept running, so the soffice
+    startup of several seconds is paid once per worker, not per document.
+    A worker that crashed, failed a conversion or hung past the timeout is
+    killed and started again for the next document.
+    """
+
+    def __init__(self, size: int = OFFICE_WORKERS, timeout: float = OFFICE_TIMEOUT):
+        self.size = size
+        self.timeout = timeout
+        self._workers: List[OfficeWorker] = []
+        self._idle: Optional[asyncio.Queue] = None
+
+    @property
+    def available(self) -> bool:
+        """Whether the pool can run (UNO bridge and soffice are installed)."""
+        return uno is not None and SOFFICE_EXE is not None and self.size > 0
+
+    def _get_idle(self) -> asyncio.Queue:
+        """Get the queue of free workers, creating the workers on first use."""
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for index in range(self.size):
+                worker = OfficeWorker(OFFICE_PORT + index)
+                self._workers.append(worker)
+                self._idle.put_nowait(worker)
+        return self._idle
+
+    async def convert(self, source_path: str, target_path: str) -> None:
+        """Convert the document to PDF on the next free worker."""
+        idle = self._get_idle()
+        worker = await idle.get()
+        call = None
+        try:
+            # Вызовы в потоке защищены от отмены: поток все равно доработает до конца
+            if not worker.alive:
+                call = asyncio.ensure_future(asyncio.to_thread(worker.start))
+                await asyncio.shield(call)
+            call = asyncio.ensure_future(asyncio.to_thread(worker.convert, source_path, target_path))
+            try:
+                await asyncio.wait_for(asyncio.shield(call), self.timeout)
+            except asyncio.TimeoutError:
+                # Зависший soffice убиваем: поток с вызовом UNO завершится с ошибкой соединения
+                logger.warning(f"LibreOffice worker on port {worker.port} hung, restarting it")
+                worker.stop()
+                raise OfficeError(f"Превышено время конвертации документа ({self.timeout} с)")
+            except OfficeError:
+                raise
+            except Exception as e:
+                logger.warning(f"LibreOffice worker on port {worker.port} failed, restarting it: {str(e)}")
+                worker.stop()
+                raise OfficeError(f"Ошибка LibreOffice: {str(e)}")
+        except asyncio.CancelledError:
+            # Убитый soffice обрывает вызов UNO, и поток быстро завершается
+            worker.stop()
+            raise
+        finally:
+            self._release(idle, worker, call)
+
+    @staticmethod
+    def _release(idle: asyncio.Queue, worker: OfficeWorker, call: Optional[asyncio.Future]) -> None:
+        """Return the worker to the idle queue once its thread call has finished."""
+        def put_back(future: asyncio.Future) -> None:
+            if not future.cancelled() and future.exception() is not None:
+                logger.debug(f"LibreOffice worker on port {worker.port} finished with: {future.exception()}")
+            idle.put_nowait(worker)
+        if call is None or call.done():
+            idle.put_nowait(worker)
+        else:
+            call.add_done_callback(put_back)
+
+    def shutdown(self) -> None:
+        """Stop all workers."""
+        for worker in self._workers:
+            worker.stop()
+
+OFFICE_POOL = OfficePool()
+
+async def _convert_cold(source_path: str, target_path: str) -> None:
+    """Convert with a one-off `soffice --convert-to pdf` run."""
+    out_dir = tempfile.mkdtemp(prefix='convert-', dir=os.path.dirname(os.path.abspath(target_path)))
+    # Свой профиль на каждый запуск: с общим профилем второй soffice отдает задачу первому и выходит
+    profile_url = Path(out_dir, 'profile').as_uri()
+    try:
+        process = await asyncio.create_subprocess_exec(
+            SOFFICE_EXE, '--headless', '--norestore', f'-env:UserInstallation={profile_url}',
+            '--convert-to', 'pdf', '--outdir', out_dir, source_path,
+            stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            _, stderr = await asyncio.wait_for(process.communicate(), OFFICE_TIMEOUT)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise OfficeError(f"Превышено время конвертации документа ({OFFICE_TIMEOUT} с)")
+        output_path = os.path.join(out_dir, f"{Path(source_path).stem}.pdf")
+        if process.returncode != 0 or not os.path.exists(output_path):
+            raise OfficeError(f"Ошибка LibreOffice: {stderr.decode('utf-8', errors='replace').strip()}")
+        os.replace(output_path, target_path)
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+async def convert_to_pdf(source_path: str, target_path: str) -> None:
+    """Convert a DOC/DOCX document to PDF without blocking the event loop.
+
+    Uses the warm LibreOffice pool when the UNO bridge is available, a
+    one-off soffice run when only LibreOffice is installed, and Microsoft
+    Word through docx2pdf otherwise (Windows/macOS).
+    """
+    if OFFICE_POOL.available:
+        await OFFICE_POOL.convert(source_path, target_path)
+    elif SOFFICE_EXE is not None:
+        await _convert_cold(source_path, target_path)
+    else:
+        from docx2pdf import convert
+        await asyncio.to_thread(convert, source_path, target_path)
@@ -0,0 +1,90 @@
+"""
+PDF to plain text, extracted by page ranges in the worker pool.
+"""
+import os
+import shutil
+import asyncio
+import logging
+from typing import List, Optional, Tuple
+from PyPDF2 import PdfReader
+from src.config import PDF_SHARD_PAGES
+from src.workers import run_in_process
+
+logger = logging.getLogger(__name__)
+
+PAGE_SEPARATOR = '\n\n'
+
+class PageRangeError(ValueError):
+    """The requested pages are not in the document."""
+
+def count_pages(source_path: str) -> int:
+    """Number of pages in the PDF."""
+    return len(PdfReader(source_path).pages)
+
+def page_slice(pages: Optional[Tuple[int, Optional[int]]], total: int) -> Tuple[int, int]:
+    """Zero-based [start, stop) for a 1-based (first, last) range; the whole document for None."""
+    if not pages:
+        return 0, total
+    first, last = pages
+    if first > total:
+        raise PageRangeError(f"В документе всего {total} стр., страницы {first} в нем нет.")
+    return first - 1, min(last or total, total)
+
+def split_pages(start: int, stop: int, shard_pages: int = PDF_SHARD_PAGES) -> List[Tuple[int, int]]:
+    """Split pages [start, stop) into ranges of at most shard_pages pages."""
+    shard_pages = max(shard_pages, 1)
+    return [(first, min(first + shard_pages, stop)) for first in range(start, stop, shard_pages)]
+
+def extract_pages(source_path: str, start: int, stop: int, target_path: str) -> int:
+    """Write the text of pages [start, stop) to a UTF-8 file; returns characters written.
+
+    Each page is written as soon as it is extracted, so only one page of text
+    is held in memory.
+    """
+    reader = PdfReader(source_path)
+    written = 0
+    with open(target_path, 'w', encoding='utf-8') as target:
+        for index in range(start, stop):
+            try:
+                text = reader.pages[index].extract_text() or ''
+            except Exception as e:
+                # Одна битая страница не должна срывать весь документ
+                logger.warning(f"Cannot extract text from page {index + 1}: {str(e)}")
+                text = ''
+            if index > start:
+                written += target.write(PAGE_SEPARATOR)
+            written += target.write(text)
+    return written
+
+async def pdf_to_text(source_path: str, target_path: str, work_dir: str,
+                      pages: Optional[Tuple[int, Optional[int]]] = None) -> int:
+    """Extract the text of a PDF into target_path using all worker processes.
+
+    Page ranges are extracted in parallel into part files in work_dir; the
+    parts are appended to the result in page order as soon as each one and
+    all before it are ready, then deleted. `pages` limits the extraction to
+    a 1-based (first, last) range. Returns the number of pages extracted.
+    """
+    start, stop = page_slice(pages, await run_in_process(count_pages, source_path))
+    shards = split_pages(start, stop)
+    logger.info(f"Extracting text from {stop - start} PDF pages in {len(shards)} parts")
+
+    parts = [os.path.join(work_dir, f'text_{index:04d}.txt') for index in range(len(shards))]
+    tasks = [
+        asyncio.ensure_future(run_in_process(extract_pages, source_path, start, stop, part))
+        for (start, stop), part in zip(shards, parts)
+    ]
+    try:
+        with open(target_path, 'wb') as target:
+            for index, (task, part) in enumerate(zip(tasks, parts)):
+                await task
+                if index:
+                    # Разделитель между частями: внутри части его пишет extract_pages
+                    target.write(PAGE_SEPARATOR.encode('utf-8'))
+                with open(part, 'rb') as f:
+                    shutil.copyfileobj(f, target)
+                os.remove(part)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return stop - start
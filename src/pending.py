@@ -0,0 +1,132 @@
+"""
+Store of pending uploads waiting for a conversion choice.
+"""
+import time
+import logging
+from collections import OrderedDict
+from typing import Hashable, Optional
+from src.config import PENDING_TTL, PENDING_MAX_BYTES, PENDING_SPILL_BYTES
+from src.spool import SPOOL, spill_upload, discard_upload
+
+logger = logging.getLogger(__name__)
+
+MAX_EXPIRED_MARKS = 10000
+
+class PendingUploadStore:
+    """Per-user pending uploads with a TTL and a global memory budget.
+
+    Entries are keyed by (user_id, kind), where kind is 'image', 'document' or
+    'video'. Reading an entry refreshes its TTL and LRU position. When the
+    in-memory bytes exceed the budget, the least recently used uploads are
+    evicted; uploads above the spill threshold are kept on disk instead.
+    Expired and evicted keys are remembered for a while so handlers can tell
+    the user to resend the file.
+    """
+
+    def __init__(self, ttl: float = PENDING_TTL, max_bytes: int = PENDING_MAX_BYTES,
+                 spill_bytes: Optional[int] = PENDING_SPILL_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.spill_bytes = spill_bytes
+        self.memory_bytes = 0
+        self._entries = OrderedDict()
+        self._expired = OrderedDict()
+
+    def put(self, user_id: Hashable, kind: str, upload: dict) -> None:
+        """Store an upload, replacing the user's previous one of the same kind."""
+        self.sweep()
+        key = (user_id, kind)
+        self._remove(key)
+        self._expired.pop(key, None)
+
+        if 'bytes' in upload and self.spill_bytes is not None and upload['size'] >= self.spill_bytes:
+            logger.info(f"Spilling {upload['size']} byte upload of {user_id} to disk")
+            upload = spill_upload(upload)
+
+        self._entries[key] = {'upload': upload, 'expires': time.monotonic() + self.ttl}
+        self.memory_bytes += self._memory_size(upload)
+        self._enforce_budget(keep=key)
+
+    def get(self, user_id: Hashable, kind: str) -> Optional[dict]:
+        """Get the user's upload and refresh its TTL; None if there is none."""
+        self.sweep()
+        key = (user_id, kind)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        entry['expires'] = time.monotonic() + self.ttl
+        self._entries.move_to_end(key)
+        SPOOL.touch(entry['upload'].get('spool_dir'))
+        return entry['upload']
+
+    def has(self, user_id: Hashable, kind: str) -> bool:
+        """Check whether the user has a live upload of this kind."""
+        return self.get(user_id, kind) is not None
+
+    def expired(self, user_id: Hashable, kind: str) -> bool:
+        """Check whether the user's upload was dropped because of the TTL or the budget."""
+        self.sweep()
+        return (user_id, kind) in self._expired
+
+    def discard(self, user_id: Hashable, kind: Optional[str] = None) -> None:
+        """Remove the user's upload of the given kind (all kinds if None)."""
+        keys = [*self._entries, *self._expired]
+        kinds = [kind] if kind else {key[1] for key in keys if key[0] == user_id}
+        for entry_kind in kinds:
+            self._remove((user_id, entry_kind))
+            self._expired.pop((user_id, entry_kind), None)
+
+    def sweep(self) -> None:
+        """Drop uploads whose TTL has passed."""
+        now = time.monotonic()
+        for key in [key for key, entry in self._entries.items() if entry['expires'] <= now]:
+            logger.info(f"Pending {key[1]} of {key[0]} expired")
+            self._expire(key)
+
+        while self._expired and next(iter(self._expired.values())) <= now:
+            self._expired.popitem(last=False)
+
+    def expire_spool_dir(self, spool_dir: str) -> None:
+        """Expire the upload kept in a spool directory that is being evicted."""
+        for key, entry in list(self._entries.items()):
+            if entry['upload'].get('spool_dir') == spool_dir:
+                logger.info(f"Pending {key[1]} of {key[0]} evicted from the spool")
+                self._expire(key)
+
+    def _enforce_budget(self, keep: Hashable) -> None:
+        """Evict least recently used in-memory uploads until the budget is met."""
+        for key in list(self._entries):
+            if self.memory_bytes <= self.max_bytes:
+                break
+            if key == keep or not self._memory_size(self._entries[key]['upload']):
+                continue
+            logger.info(f"Evicting pending {key[1]} of {key[0]}: memory budget exceeded")
+            self._expire(key)
+
+        if self.memory_bytes > self.max_bytes and keep in self._entries:
+            # Одна загрузка больше всего лимита - держим ее на диске
+            entry = self._entries[keep]
+            self.memory_bytes -= self._memory_size(entry['upload'])
+            entry['upload'] = spill_upload(entry['upload'])
+
+    def _expire(self, key: Hashable) -> None:
+        """Remove an entry and remember that it expired."""
+        self._remove(key)
+        self._expired[key] = time.monotonic() + self.ttl
+        while len(self._expired) > MAX_EXPIRED_MARKS:
+            self._expired.popitem(last=False)
+
+    def _remove(self, key: Hashable) -> None:
+        """Remove an entry and delete its spooled file."""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.memory_bytes -= self._memory_size(entry['upload'])
+            discard_upload(entry['upload'])
+
+    @staticmethod
+    def _memory_size(upload: dict) -> int:
+        """Bytes of the upload held in memory."""
+        return len(upload['bytes']) if 'bytes' in upload else 0
+
+PENDING_UPLOADS = PendingUploadStore()
+SPOOL.on_evict = PENDING_UPLOADS.expire_spool_dir
@@ -0,0 +1,200 @@
+"""
+FFprobe analysis of media files, memoized per Telegram file.
+"""
+import json
+import asyncio
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Hashable, List, Optional, Union
+from src import ffmpeg_runner
+from src.config import PROBE_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+KEYFRAME_SCAN_SECONDS = 60  # Интервал ключевых кадров оценивается по началу файла
+
+def _to_float(value) -> Optional[float]:
+    """Parse an FFprobe number, None for missing or N/A values."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _to_int(value) -> Optional[int]:
+    """Parse an FFprobe integer, None for missing or N/A values."""
+    number = _to_float(value)
+    return int(number) if number is not None else None
+
+@dataclass
+class StreamInfo:
+    """One stream of a media file."""
+    index: int
+    codec_type: str
+    codec_name: Optional[str] = None
+    bit_rate: Optional[int] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    frame_rate: Optional[float] = None
+    attached_pic: bool = False
+    rotation: int = 0
+
+    @classmethod
+    def from_ffprobe(cls, stream: dict) -> 'StreamInfo':
+        """Build from one entry of FFprobe's "streams" list."""
+        frame_rate = None
+        numerator, _, denominator = stream.get('avg_frame_rate', '').partition('/')
+        if _to_float(denominator):
+            frame_rate = _to_float(numerator) / _to_float(denominator)
+
+        # Поворот пишется в display matrix (новые FFmpeg) или в теге rotate (старые)
+        rotation = stream.get('tags', {}).get('rotate')
+        for side_data in stream.get('side_data_list', []):
+            if 'rotation' in side_data:
+                rotation = side_data['rotation']
+
+        return cls(
+            index=stream['index'],
+            codec_type=stream.get('codec_type', ''),
+            codec_name=stream.get('codec_name'),
+            bit_rate=_to_int(stream.get('bit_rate')),
+            width=stream.get('width'),
+            height=stream.get('height'),
+            frame_rate=frame_rate,
+            attached_pic=bool(stream.get('disposition', {}).get('attached_pic')),
+            rotation=_to_int(rotation) or 0
+        )
+
+@dataclass
+class MediaInfo:
+    """Structured FFprobe result for a media file."""
+    format_name: str = ''
+    major_brand: str = ''
+    duration: float = 0.0
+    bit_rate: Optional[int] = None
+    size: Optional[int] = None
+    streams: List[StreamInfo] = field(default_factory=list)
+    keyframe_interval: Optional[float] = None
+
+    @property
+    def video(self) -> Optional[StreamInfo]:
+        """Main video stream, skipping cover art."""
+        for stream in self.streams:
+            if stream.codec_type == 'video' and not stream.attached_pic:
+                return stream
+        return None
+
+    @property
+    def audio(self) -> List[StreamInfo]:
+        """Audio streams."""
+        return [stream for stream in self.streams if stream.codec_type == 'audio']
+
+    @property
+    def rotation(self) -> int:
+        """Rotation of the main video stream in degrees."""
+        return self.video.rotation if self.video else 0
+
+    @classmethod
+    def from_ffprobe(cls, data: dict) -> 'MediaInfo':
+        """Build from FFprobe's -show_format -show_streams JSON."""
+        format_info = data.get('format', {})
+        return cls(
+            format_name=format_info.get('format_name', ''),
+            major_brand=format_info.get('tags', {}).get('major_brand', '').strip(),
+            duration=_to_float(format_info.get('duration')) or 0.0,
+            bit_rate=_to_int(format_info.get('bit_rate')),
+            size=_to_int(format_info.get('size')),
+            streams=[StreamInfo.from_ffprobe(stream) for stream in data.get('streams', [])]
+        )
+
+def _probe_input(source: Union[str, bytes]):
+    """FFprobe input argument and stdin data for a path or in-memory file."""
+    if isinstance(source, str):
+        return source, None
+    return 'pipe:0', source
+
+async def _keyframe_interval(source: Union[str, bytes], stream: StreamInfo) -> Optional[float]:
+    """Average keyframe distance of the stream, from packet flags (nothing is decoded)."""
+    path, data = _probe_input(source)
+    result = await ffmpeg_runner.run_ffprobe([
+        '-v', 'error', '-print_format', 'json', '-select_streams', str(stream.index),
+        '-read_intervals', f'%+{KEYFRAME_SCAN_SECONDS}', '-show_entries', 'packet=pts_time,flags', path
+    ], input_data=data)
+    if result.returncode != 0:
+        return None
+    times = [
+        _to_float(packet.get('pts_time'))
+        for packet in json.loads(result.stdout).get('packets', [])
+        if 'K' in packet.get('flags', '')
+    ]
+    times = sorted(time for time in times if time is not None)
+    if len(times) < 2:
+        return None
+    return (times[-1] - times[0]) / (len(times) - 1)
+
+async def _analyze(source: Union[str, bytes]) -> Optional[MediaInfo]:
+    """Run FFprobe on the file (a path or the file data); None if it is not a valid media file."""
+    path, data = _probe_input(source)
+    result = await ffmpeg_runner.run_ffprobe([
+        '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', path
+    ], input_data=data)
+    if result.returncode != 0:
+        return None
+    info = MediaInfo.from_ffprobe(json.loads(result.stdout))
+    if info.video:
+        try:
+            info.keyframe_interval = await _keyframe_interval(source, info.video)
+        except Exception as e:
+            logger.warning(f"Could not measure keyframe interval: {str(e)}")
+    return info
+
+class ProbeCache:
+    """LRU of MediaInfo keyed by Telegram file_unique_id.
+
+    Concurrent requests for the same file share one FFprobe run, so an upload
+    converted to several formats is analyzed exactly once.
+    """
+
+    def __init__(self, max_entries: int = PROBE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    async def probe(self, source: Union[str, bytes],
+                    file_unique_id: Optional[Hashable] = None) -> Optional[MediaInfo]:
+        """Get the analysis of the file, running FFprobe only on a cache miss."""
+        if file_unique_id is None or not self.max_entries:
+            return await _analyze(source)
+
+        future = self._entries.get(file_unique_id)
+        if future is None:
+            future = asyncio.ensure_future(_analyze(source))
+            self._entries[file_unique_id] = future
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(file_unique_id)
+
+        try:
+            info = await asyncio.shield(future)
+        except Exception:
+            self._forget(file_unique_id, future)
+            raise
+        if info is None:
+            # Неудачный анализ не кэшируем: файл может прийти снова
+            self._forget(file_unique_id, future)
+        return info
+
+    def _forget(self, file_unique_id: Hashable, future: asyncio.Future) -> None:
+        """Drop the entry unless it was already replaced."""
+        if self._entries.get(file_unique_id) is future:
+            del self._entries[file_unique_id]
+
+PROBE_CACHE = ProbeCache()
+
+async def probe_media(source: Union[str, bytes], file_unique_id: Optional[Hashable] = None) -> Optional[MediaInfo]:
+    """Analyze a media file (a path or the file data) with FFprobe; None if the file is invalid."""
+    try:
+        return await PROBE_CACHE.probe(source, file_unique_id)
+    except Exception as e:
+        logger.error(f"FFprobe error: {str(e)}")
+        return None
@@ -0,0 +1,107 @@
+"""
+FFmpeg progress reporting through a Telegram status message.
+"""
+import time
+import asyncio
+import logging
+from typing import Callable, Hashable, Optional
+from telegram import Message
+from telegram.error import TelegramError
+from src.config import PROGRESS_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+BAR_LENGTH = 10
+
+def format_duration(seconds: float) -> str:
+    """Format a duration as m:ss or h:mm:ss."""
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+class ProgressReporter:
+    """Edit one status message with the progress of FFmpeg processes.
+
+    FFmpeg is run with -progress pipe:1; every process gets its own line
+    callback from track(), and the percentage is the sum of their out_time
+    against the total duration. Edits are sent in the background, at most one
+    at a time and not more often than every `interval` seconds, so parsing
+    never waits on Telegram.
+    """
+
+    def __init__(self, message: Message, duration: float, title: str,
+                 interval: float = PROGRESS_INTERVAL):
+        self.message = message
+        self.duration = duration
+        self.title = title
+        self.interval = interval
+        self._done = {}
+        self._speed = {}
+        self._fields = {}
+        self._last_edit = 0.0
+        self._last_text = None
+        self._edit_task: Optional[asyncio.Task] = None
+
+    def track(self, key: Hashable) -> Callable[[str], None]:
+        """Get a line callback for the -progress output of one process."""
+        fields = self._fields.setdefault(key, {})
+
+        def on_line(line: str) -> None:
+            name, _, value = line.partition('=')
+            if name != 'progress':
+                fields[name] = value.strip()
+                return
+            # Строка progress= завершает очередной блок статистики
+            self._update(key, fields, finished=value.strip() == 'end')
+        return on_line
+
+    def _update(self, key: Hashable, fields: dict, finished: bool) -> None:
+        """Take the latest block of one process and maybe schedule an edit."""
+        try:
+            # out_time_us есть не во всех сборках; out_time_ms тоже в микросекундах
+            self._done[key] = int(fields.get('out_time_us') or fields.get('out_time_ms')) / 1_000_000
+        except (TypeError, ValueError):
+            pass
+        try:
+            self._speed[key] = 0.0 if finished else float(fields.get('speed', '').rstrip('x'))
+        except ValueError:
+            pass
+
+        now = time.monotonic()
+        if now - self._last_edit < self.interval or (self._edit_task and not self._edit_task.done()):
+            return
+        self._last_edit = now
+        text = self.render()
+        if text != self._last_text:
+            self._last_text = text
+            self._edit_task = asyncio.ensure_future(self._edit(text))
+
+    def render(self) -> str:
+        """Build the status text with a progress bar and an ETA."""
+        done = min(sum(self._done.values()), self.duration)
+        fraction = done / self.duration if self.duration else 0.0
+        filled = int(fraction * BAR_LENGTH)
+        text = f"{self.title}\n{'▓' * filled}{'░' * (BAR_LENGTH - filled)} {fraction:.0%}"
+        speed = sum(self._speed.values())
+        if speed > 0:
+            text += f"\n⏱ Осталось примерно {format_duration((self.duration - done) / speed)}"
+        return text
+
+    async def _edit(self, text: str) -> None:
+        """Edit the status message, ignoring Telegram errors."""
+        try:
+            await self.message.edit_text(text)
+        except TelegramError as e:
+            logger.debug(f"Progress edit failed: {str(e)}")
+
+    async def close(self) -> None:
+        """Stop reporting and delete the status message."""
+        if self._edit_task and not self._edit_task.done():
+            self._edit_task.cancel()
+        try:
+            await self.message.delete()
+        except TelegramError as e:
+            logger.debug(f"Could not delete progress message: {str(e)}")
@@ -0,0 +1,204 @@
+"""
+Cache of conversion results keyed by the source file and conversion options.
+"""
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Optional
+from telegram import InputFile, InputMediaDocument, Message
+from telegram.error import TelegramError
+from src.config import RESULT_CACHE_PATH, RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_MAX_AGE
+
+logger = logging.getLogger(__name__)
+
+class ResultCache:
+    """Persistent map from (file_unique_id, target format, options) to a Telegram file_id.
+
+    A repeated conversion of the same source is answered by resending the
+    stored file_id, without downloading, converting or uploading anything.
+    Entries older than max_age are dropped, and the least recently used ones
+    are evicted above max_entries. The database is opened on first use; the
+    methods block on SQLite, so the bot calls them through asyncio.to_thread
+    (lookup_result, remember_result) and a lock serializes the threads.
+    """
+
+    def __init__(self, path: str = RESULT_CACHE_PATH, max_entries: int = RESULT_CACHE_MAX_ENTRIES,
+                 max_age: float = RESULT_CACHE_MAX_AGE):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        """Open the database on first use; None when the cache is disabled."""
+        if self._conn is None and self.path:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, file_id TEXT NOT NULL, "
+                "created REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def make_key(file_unique_id: Optional[str], target_format: str, metadata_type: Optional[str] = None,
+                 **options) -> Optional[str]:
+        """Build a cache key; None when the source cannot be identified."""
+        if not file_unique_id:
+            return None
+        return json.dumps(
+            [file_unique_id, target_format.upper(), metadata_type, options],
+            sort_keys=True, ensure_ascii=False
+        )
+
+    def get(self, key: Optional[str]) -> Optional[str]:
+        """Get the cached file_id for the key."""
+        if key is None or not self.path:
+            return None
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT file_id FROM results WHERE key = ? AND created > ?", (key, now - self.max_age)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                logger.info(f"Result cache miss ({self.stats_text()})")
+                return None
+            conn.execute("UPDATE results SET last_used = ? WHERE key = ?", (now, key))
+            conn.commit()
+            self.hits += 1
+        logger.info(f"Result cache hit ({self.stats_text()})")
+        return row[0]
+
+    def put(self, key: Optional[str], file_id: str) -> None:
+        """Remember the file_id of a sent result and evict old entries."""
+        if key is None or not self.path:
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO results (key, file_id, created, last_used) VALUES (?, ?, ?, ?)",
+                (key, file_id, now, now)
+            )
+            conn.execute("DELETE FROM results WHERE created <= ?", (now - self.max_age,))
+            conn.execute(
+                "DELETE FROM results WHERE key IN ("
+                "SELECT key FROM results ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            conn.commit()
+
+    def delete(self, key: Optional[str]) -> None:
+        """Forget a cached result."""
+        if key is None or not self.path:
+            return
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM results WHERE key = ?", (key,))
+            conn.commit()
+
+    def stats(self) -> dict:
+        """Get hit/miss counters and the number of stored entries."""
+        entries = 0
+        if self.path:
+            with self._lock:
+                entries = self._connect().execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries}
+
+    def stats_text(self) -> str:
+        """Format hit/miss counters for logs."""
+        total = self.hits + self.misses
+        ratio = self.hits / total * 100 if total else 0.0
+        return f"hits: {self.hits}, misses: {self.misses}, hit rate: {ratio:.1f}%"
+
+RESULT_CACHE = ResultCache()
+
+async def lookup_result(key: Optional[str]) -> Optional[str]:
+    """Get the cached file_id for the key without blocking the event loop."""
+    if key is None:
+        return None
+    return await asyncio.to_thread(RESULT_CACHE.get, key)
+
+async def forget_result(key: Optional[str]) -> None:
+    """Delete a cached result without blocking the event loop."""
+    if key is not None:
+        await asyncio.to_thread(RESULT_CACHE.delete, key)
+
+async def reply_cached(message: Message, key: Optional[str], caption: str) -> bool:
+    """Resend a cached result; returns False if there is nothing usable in the cache."""
+    file_id = await lookup_result(key)
+    if file_id is None:
+        return False
+    try:
+        await message.reply_document(document=file_id, caption=caption)
+        return True
+    except TelegramError as e:
+        logger.warning(f"Cached file_id is no longer valid: {str(e)}")
+        await forget_result(key)
+        return False
+
+def _open_document(stack: ExitStack, document, filename: str, attach: bool = False):
+    """Wrap a Path into an InputFile read from disk while it is uploaded."""
+    if not isinstance(document, Path):
+        return document
+    # Файл не читается в память целиком: httpx отправляет его частями
+    file = stack.enter_context(open(document, 'rb'))
+    return InputFile(file, filename=filename, attach=attach, read_file_handle=False)
+
+async def reply_result(message: Message, key: Optional[str], document, filename: str, caption: str) -> None:
+    """Send a converted file and remember its file_id.
+
+    document is the result itself; a Path is streamed from disk, so large
+    results cost no memory.
+    """
+    with ExitStack() as stack:
+        sent = await message.reply_document(
+            document=_open_document(stack, document, filename), filename=filename, caption=caption
+        )
+    await remember_result(key, sent)
+
+async def reply_document_group(message: Message, items: list, caption: str) -> None:
+    """Send several results as one media group and remember their file_ids.
+
+    items are (key, document, filename) tuples, where document is the result
+    itself (a Path is streamed from disk) or a cached file_id; the caption
+    goes under the last document.
+    """
+    with ExitStack() as stack:
+        media = [
+            InputMediaDocument(media=_open_document(stack, document, filename, attach=True), filename=filename,
+                               caption=caption if index == len(items) - 1 else None)
+            for index, (_, document, filename) in enumerate(items)
+        ]
+        try:
+            sent = await message.reply_media_group(media=media)
+        except TelegramError:
+            # Какой-то из кэшированных file_id мог устареть - при повторе файлы отправятся заново
+            for key, document, _ in items:
+                if isinstance(document, str):
+                    await forget_result(key)
+            raise
+    for (key, _, _), result in zip(items, sent):
+        await remember_result(key, result)
+
+async def remember_result(key: Optional[str], sent: Message) -> None:
+    """Store the file_id of a sent document for the key; the write and eviction run in a thread."""
+    if key is not None and sent is not None and sent.document is not None:
+        await asyncio.to_thread(RESULT_CACHE.put, key, sent.document.file_id)
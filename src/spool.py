@@ -0,0 +1,213 @@
+"""
+Storage of uploaded files in memory or in the spool directory.
+"""
+import os
+import shutil
+import logging
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Optional
+from src.config import SPOOL_DOWNLOADS, SPOOL_DIR, SPOOL_QUOTA_BYTES
+
+logger = logging.getLogger(__name__)
+
+JOB_PREFIX = 'job-'
+WORK_PREFIX = 'work-'
+
+class SpoolFullError(OSError):
+    """Not enough room in the spool directory."""
+
+def _dir_size(path: str) -> int:
+    """Total size of the files under the directory."""
+    total = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                total += os.path.getsize(os.path.join(dir_path, file_name))
+            except OSError:
+                pass
+    return total
+
+class SpoolManager:
+    """Job directories under one spool root with a quota.
+
+    A job directory holds a spooled upload for as long as it is pending
+    (removal waits for running conversions); every conversion gets its own
+    work directory inside it, removed when the conversion ends. Uploads kept
+    in memory get a throwaway job directory per conversion. When a new job
+    would exceed the quota, the least recently used idle job directories are
+    evicted (on_evict lets the pending store forget their uploads); if that
+    is not enough the job is refused with SpoolFullError. Reserved bytes
+    count against the quota until the files are actually written, so
+    concurrent jobs cannot all pass the check against the same free space.
+    The quota is capped at what the spool filesystem can hold, so a small
+    tmpfs root (e.g. Docker's 64 MB /dev/shm) evicts instead of filling up.
+    """
+
+    def __init__(self, root: str = SPOOL_DIR, quota: int = SPOOL_QUOTA_BYTES):
+        self.root = root
+        self.quota = quota
+        self.on_evict: Optional[Callable[[str], None]] = None
+        self._jobs = OrderedDict()  # job directory -> number of running conversions
+        self._work = {}  # work directory -> (job directory, job is throwaway)
+        self._doomed = set()  # jobs to remove once their conversions finish
+        self._reserved = {}  # job or work directory -> bytes reserved for it
+
+    def sweep(self) -> None:
+        """Remove job directories left over by a previous run."""
+        os.makedirs(self.root, exist_ok=True)
+        for entry in os.scandir(self.root):
+            if entry.name.startswith(JOB_PREFIX) and entry.path not in self._jobs:
+                logger.info(f"Removing orphaned spool directory {entry.path}")
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    def create_job(self, reserve: int = 0) -> str:
+        """Create a job directory with room for `reserve` more bytes."""
+        self.make_room(reserve)
+        os.makedirs(self.root, exist_ok=True)
+        path = tempfile.mkdtemp(prefix=JOB_PREFIX, dir=self.root)
+        self._jobs[path] = 0
+        if reserve:
+            self._reserved[path] = reserve
+        return path
+
+    def remove_job(self, path: Optional[str]) -> None:
+        """Delete a job directory with everything in it."""
+        if not path:
+            return
+        if self._jobs.get(path):
+            # Идет конвертация: удалим, когда она закончится
+            self._doomed.add(path)
+            return
+        self._jobs.pop(path, None)
+        self._doomed.discard(path)
+        self._reserved.pop(path, None)
+        shutil.rmtree(path, ignore_errors=True)
+
+    def touch(self, path: Optional[str]) -> None:
+        """Mark the job directory as recently used."""
+        if path in self._jobs:
+            self._jobs.move_to_end(path)
+
+    def acquire(self, job_dir: Optional[str] = None, reserve: int = 0) -> str:
+        """Create a work directory for one conversion inside the job directory."""
+        throwaway = job_dir not in self._jobs
+        self.make_room(reserve, keep=None if throwaway else job_dir)
+        if throwaway:
+            job_dir = self.create_job()
+        self._jobs[job_dir] += 1
+        self._jobs.move_to_end(job_dir)
+        path = tempfile.mkdtemp(prefix=WORK_PREFIX, dir=job_dir)
+        self._work[path] = (job_dir, throwaway)
+        if reserve:
+            self._reserved[path] = reserve
+        return path
+
+    def release(self, path: Optional[str]) -> None:
+        """Delete a work directory created by acquire()."""
+        if not path or path not in self._work:
+            return
+        job_dir, throwaway = self._work.pop(path)
+        self._reserved.pop(path, None)
+        shutil.rmtree(path, ignore_errors=True)
+        if job_dir in self._jobs:
+            self._jobs[job_dir] -= 1
+        if throwaway or job_dir in self._doomed:
+            self.remove_job(job_dir)
+
+    @contextmanager
+    def work_dir(self, job_dir: Optional[str] = None, reserve: int = 0):
+        """Work directory for one conversion, removed on exit."""
+        path = self.acquire(job_dir, reserve)
+        try:
+            yield path
+        finally:
+            self.release(path)
+
+    def _unwritten(self, path: str) -> int:
+        """Bytes reserved for the directory but not written yet."""
+        reserve = self._reserved.get(path, 0)
+        return max(reserve - _dir_size(path), 0) if reserve else 0
+
+    def usage(self) -> int:
+        """Bytes used by all job directories plus the unwritten part of the reservations."""
+        return sum(_dir_size(path) for path in self._jobs) + sum(self._unwritten(path) for path in self._reserved)
+
+    def capacity(self) -> Optional[int]:
+        """The quota, capped at the spool's own files plus the free space of its filesystem; None - no limit."""
+        try:
+            free = shutil.disk_usage(self.root).free
+        except OSError:
+            # Корень еще не создан: ограничиваемся квотой
+            return self.quota or None
+        capacity = free + sum(_dir_size(path) for path in self._jobs)
+        return min(self.quota, capacity) if self.quota else capacity
+
+    def make_room(self, nbytes: int, keep: Optional[str] = None) -> None:
+        """Evict idle job directories until `nbytes` more fit into the capacity."""
+        capacity = self.capacity()
+        if capacity is None:
+            return
+        usage = self.usage()
+        for path in list(self._jobs):
+            if usage + nbytes <= capacity:
+                break
+            if path == keep or self._jobs.get(path):
+                continue
+            size = _dir_size(path) + self._unwritten(path)
+            logger.info(f"Evicting spool directory {path} ({size} bytes): quota exceeded")
+            if self.on_evict:
+                self.on_evict(path)
+            self.remove_job(path)
+            usage -= size
+        if usage + nbytes > capacity:
+            raise SpoolFullError("Недостаточно места для обработки файла. Попробуйте позже.")
+
+SPOOL = SpoolManager()
+
+async def download_upload(bot, file_id: str, file_name: str = None) -> dict:
+    """Download a Telegram file into memory or straight into a spool job directory."""
+    tg_file = await bot.get_file(file_id)
+
+    if SPOOL_DOWNLOADS:
+        job_dir = SPOOL.create_job(reserve=tg_file.file_size or 0)
+        path = os.path.join(job_dir, f"source{Path(file_name or tg_file.file_path or '').suffix}")
+        try:
+            await tg_file.download_to_drive(path)
+        except Exception:
+            SPOOL.remove_job(job_dir)
+            raise
+        size = os.path.getsize(path)
+        logger.info(f"File spooled to {path}, size: {size} bytes")
+        return {'path': path, 'spool_dir': job_dir, 'size': size}
+
+    data = await tg_file.download_as_bytearray()
+    return {'bytes': data, 'size': len(data)}
+
+def upload_to_path(upload: dict, path: str) -> str:
+    """Get a filesystem path for the upload, writing in-memory data to `path` if needed."""
+    if 'path' in upload:
+        return upload['path']
+    with open(path, 'wb') as f:
+        f.write(upload['bytes'])
+    return path
+
+def spill_upload(upload: dict) -> dict:
+    """Move in-memory upload data to a spool job directory."""
+    if 'path' in upload:
+        return upload
+    job_dir = SPOOL.create_job(reserve=upload['size'])
+    path = os.path.join(job_dir, f"source{Path(upload.get('name') or '').suffix}")
+    with open(path, 'wb') as f:
+        f.write(upload['bytes'])
+    spilled = {key: value for key, value in upload.items() if key != 'bytes'}
+    spilled['path'] = path
+    spilled['spool_dir'] = job_dir
+    return spilled
+
+def discard_upload(upload: dict) -> None:
+    """Delete the spool job directory of the upload, if any."""
+    if upload and 'spool_dir' in upload:
+        SPOOL.remove_job(upload['spool_dir'])
@@ -0,0 +1,297 @@
+"""
+Plain text to PDF, written page by page without intermediate documents.
+"""
+import os
+import zlib
+import codecs
+import struct
+import logging
+from functools import lru_cache
+from typing import Dict, Iterator, Optional, TextIO
+from src.config import PDF_FONT_PATH
+
+logger = logging.getLogger(__name__)
+
+PAGE_WIDTH = 595  # A4, пункты
+PAGE_HEIGHT = 842
+MARGIN = 36
+FONT_SIZE = 9
+LEADING = 10.8
+TAB_SIZE = 4
+READ_LIMIT = 64 * 1024  # Очень длинные строки читаются частями
+DETECT_BYTES = 64 * 1024
+
+# Моноширинные TrueType шрифты с кириллицей; без них остается Courier (только Latin-1)
+FONT_CANDIDATES = [
+    '/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf',
+    '/usr/share/fonts/dejavu/DejaVuSansMono.ttf',
+    '/usr/share/fonts/TTF/DejaVuSansMono.ttf',
+    'C:\\Windows\\Fonts\\consola.ttf',
+    '/System/Library/Fonts/Supplemental/Courier New.ttf'
+]
+
+def detect_encoding(path: str) -> str:
+    """Guess the text encoding from a BOM or the first bytes: UTF-8, else cp1251."""
+    with open(path, 'rb') as f:
+        head = f.read(DETECT_BYTES)
+    if head.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    try:
+        # Последний символ образца может быть обрезан - его не проверяем
+        codecs.getincrementaldecoder('utf-8')().decode(head, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'cp1251'
+
+def wrap_lines(f: TextIO, width: int) -> Iterator[str]:
+    """Yield the text as lines of at most width characters, reading it incrementally."""
+    pending = ''
+    while True:
+        piece = f.readline(READ_LIMIT)
+        if not piece:
+            break
+        ended = piece.endswith('\n')
+        text = pending + piece.rstrip('\r\n').expandtabs(TAB_SIZE)
+        while len(text) > width:
+            yield text[:width]
+            text = text[width:]
+        if ended:
+            yield text
+            pending = ''
+        else:
+            pending = text
+    if pending:
+        yield pending
+
+class FontMissingError(ValueError):
+    """The text has characters that Courier cannot show and no TrueType font is available."""
+
+class TrueTypeFont:
+    """The parts of a TrueType font needed to embed it as a CID font."""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self.data = f.read()
+        tables = self._tables()
+        head, hhea, hmtx = tables[b'head'], tables[b'hhea'], tables[b'hmtx']
+        units = struct.unpack_from('>H', self.data, head + 18)[0]
+        scale = 1000 / units
+        self.bbox = [round(value * scale) for value in struct.unpack_from('>4h', self.data, head + 36)]
+        ascender, descender = struct.unpack_from('>2h', self.data, hhea + 4)
+        self.ascent = round(ascender * scale)
+        self.descent = round(descender * scale)
+        self.cmap = self._unicode_cmap(tables[b'cmap'])
+        # Шрифт моноширинный: ширина одного глифа годится для всех
+        metrics = struct.unpack_from('>H', self.data, hhea + 34)[0]
+        glyph = min(self.cmap.get(ord('M'), 0), metrics - 1)
+        self.width = round(struct.unpack_from('>H', self.data, hmtx + glyph * 4)[0] * scale)
+        self.name = ''.join(char for char in os.path.splitext(os.path.basename(path))[0] if char.isalnum())
+
+    def _tables(self) -> Dict[bytes, int]:
+        """Offsets of the font tables."""
+        count = struct.unpack_from('>H', self.data, 4)[0]
+        tables = {}
+        for index in range(count):
+            tag, _, offset, _ = struct.unpack_from('>4sIII', self.data, 12 + index * 16)
+            tables[tag] = offset
+        return tables
+
+    def _unicode_cmap(self, offset: int) -> Dict[int, int]:
+        """Unicode (BMP) to glyph id mapping from a format 4 cmap subtable."""
+        count = struct.unpack_from('>H', self.data, offset + 2)[0]
+        for index in range(count):
+            platform, encoding, subtable = struct.unpack_from('>HHI', self.data, offset + 4 + index * 8)
+            start = offset + subtable
+            if (platform, encoding) in ((3, 1), (0, 3)) and struct.unpack_from('>H', self.data, start)[0] == 4:
+                return self._parse_format4(start)
+        raise ValueError("В шрифте нет таблицы Unicode cmap формата 4")
+
+    def _parse_format4(self, start: int) -> Dict[int, int]:
+        """Parse a segment mapping (format 4) cmap subtable."""
+        segments = struct.unpack_from('>H', self.data, start + 6)[0] // 2
+        ends = struct.unpack_from(f'>{segments}H', self.data, start + 14)
+        starts = struct.unpack_from(f'>{segments}H', self.data, start + 16 + segments * 2)
+        deltas = struct.unpack_from(f'>{segments}h', self.data, start + 16 + segments * 4)
+        range_base = start + 16 + segments * 6
+        range_offsets = struct.unpack_from(f'>{segments}H', self.data, range_base)
+        cmap = {}
+        for segment in range(segments):
+            for code in range(starts[segment], ends[segment] + 1):
+                if code == 0xFFFF:
+                    continue
+                if range_offsets[segment] == 0:
+                    glyph = (code + deltas[segment]) & 0xFFFF
+                else:
+                    address = (range_base + segment * 2 + range_offsets[segment]
+                               + (code - starts[segment]) * 2)
+                    glyph = struct.unpack_from('>H', self.data, address)[0]
+                    if glyph:
+                        glyph = (glyph + deltas[segment]) & 0xFFFF
+                if glyph:
+                    cmap[code] = glyph
+        return cmap
+
+@lru_cache(maxsize=4)
+def load_font(path: str) -> Optional[TrueTypeFont]:
+    """Load the configured or the first installed monospace font; None if there is none."""
+    if path and not os.path.isfile(path):
+        logger.warning(f"PDF font {path} not found, trying the installed fonts")
+    for candidate in ([path] if path else []) + FONT_CANDIDATES:
+        if os.path.isfile(candidate):
+            try:
+                return TrueTypeFont(candidate)
+            except (ValueError, KeyError, struct.error) as e:
+                logger.warning(f"Cannot use font {candidate}: {str(e)}")
+    return None
+
+class TextPdfWriter:
+    """Write monospace text pages straight into a PDF file.
+
+    Every page is compressed and written as soon as it is full; only the
+    object offsets and the set of used glyphs stay in memory. Object numbers
+    1-7 are reserved for the catalog, the page tree and the font objects,
+    which are written last.
+    """
+
+    FIRST_PAGE_OBJECT = 8
+
+    def __init__(self, f, font: Optional[TrueTypeFont]):
+        self.f = f
+        self.font = font
+        self.offsets = {}
+        self.pages = []
+        self.used = {}  # glyph id -> символ, для ToUnicode
+        self.next_object = self.FIRST_PAGE_OBJECT
+        char_width = (font.width if font else 600) * FONT_SIZE / 1000
+        self.columns = int((PAGE_WIDTH - 2 * MARGIN) // char_width)
+        self.rows = int((PAGE_HEIGHT - 2 * MARGIN) // LEADING)
+        self.f.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def _object(self, number: int, body: bytes) -> None:
+        """Write one indirect object."""
+        self.offsets[number] = self.f.tell()
+        self.f.write(f'{number} 0 obj\n'.encode())
+        self.f.write(body)
+        self.f.write(b'\nendobj\n')
+
+    def _stream(self, number: int, data: bytes, entries: str = '') -> None:
+        """Write a Flate-compressed stream object with extra dictionary entries."""
+        compressed = zlib.compress(data)
+        header = f'<< {entries}/Length {len(compressed)} /Filter /FlateDecode >>\nstream\n'.encode()
+        self._object(number, header + compressed + b'\nendstream')
+
+    def _encode(self, line: str) -> str:
+        """Hex string of the line in the font's encoding."""
+        line = ''.join(char if char >= ' ' else ' ' for char in line)
+        if self.font is None:
+            try:
+                return line.encode('cp1252').hex()
+            except UnicodeEncodeError:
+                # Вместо нечитаемого PDF из знаков вопроса
+                raise FontMissingError(
+                    "На сервере нет шрифта для символов этого текста (например, кириллицы), "
+                    "PDF получился бы нечитаемым."
+                )
+        glyphs = []
+        for char in line:
+            glyph = self.font.cmap.get(ord(char), 0)
+            self.used.setdefault(glyph, char)
+            glyphs.append(glyph)
+        return struct.pack(f'>{len(glyphs)}H', *glyphs).hex()
+
+    def add_page(self, lines: list) -> None:
+        """Write one page of text lines."""
+        content = [f'BT /F1 {FONT_SIZE} Tf {LEADING} TL {MARGIN} {PAGE_HEIGHT - MARGIN - FONT_SIZE} Td'.encode()]
+        for line in lines:
+            content.append(f'<{self._encode(line)}> Tj T*'.encode())
+        content.append(b'ET')
+        page, contents = self.next_object, self.next_object + 1
+        self.next_object += 2
+        self._stream(contents, b'\n'.join(content))
+        self._object(page, (
+            f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] '
+            f'/Resources << /Font << /F1 3 0 R >> >> /Contents {contents} 0 R >>'
+        ).encode())
+        self.pages.append(page)
+
+    def write_lines(self, lines: Iterator[str]) -> None:
+        """Lay out the lines into pages, writing each page when it is full."""
+        page = []
+        for line in lines:
+            page.append(line)
+            if len(page) == self.rows:
+                self.add_page(page)
+                page = []
+        if page or not self.pages:
+            self.add_page(page)
+
+    def _write_font(self) -> None:
+        """Write the font objects (3-7)."""
+        if self.font is None:
+            self._object(3, b'<< /Type /Font /Subtype /Type1 /BaseFont /Courier /Encoding /WinAnsiEncoding >>')
+            return
+        font = self.font
+        self._object(3, (
+            f'<< /Type /Font /Subtype /Type0 /BaseFont /{font.name} /Encoding /Identity-H '
+            f'/DescendantFonts [4 0 R] /ToUnicode 7 0 R >>'
+        ).encode())
+        self._object(4, (
+            f'<< /Type /Font /Subtype /CIDFontType2 /BaseFont /{font.name} '
+            f'/CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) /Supplement 0 >> '
+            f'/FontDescriptor 5 0 R /DW {font.width} /CIDToGIDMap /Identity >>'
+        ).encode())
+        self._object(5, (
+            f'<< /Type /FontDescriptor /FontName /{font.name} /Flags 33 '
+            f'/FontBBox [{" ".join(map(str, font.bbox))}] /ItalicAngle 0 /Ascent {font.ascent} '
+            f'/Descent {font.descent} /CapHeight {font.ascent} /StemV 80 /FontFile2 6 0 R >>'
+        ).encode())
+        self._stream(6, font.data, f'/Length1 {len(font.data)} ')
+
+        # ToUnicode нужен, чтобы текст из PDF копировался и искался
+        cmap = [
+            '/CIDInit /ProcSet findresource begin 12 dict begin begincmap',
+            '/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) /Supplement 0 >> def',
+            '/CMapName /Adobe-Identity-UCS def /CMapType 2 def',
+            '1 begincodespacerange <0000> <FFFF> endcodespacerange'
+        ]
+        used = sorted(self.used.items())
+        for start in range(0, len(used), 100):
+            chunk = used[start:start + 100]
+            cmap.append(f'{len(chunk)} beginbfchar')
+            cmap.extend(f'<{glyph:04X}> <{char.encode("utf-16-be").hex().upper()}>' for glyph, char in chunk)
+            cmap.append('endbfchar')
+        cmap.append('endcmap CMapName currentdict /CMap defineresource pop end end')
+        self._stream(7, '\n'.join(cmap).encode())
+
+    def close(self) -> None:
+        """Write the page tree, fonts, catalog, cross-reference table and trailer."""
+        kids = ' '.join(f'{page} 0 R' for page in self.pages)
+        self._object(2, f'<< /Type /Pages /Kids [{kids}] /Count {len(self.pages)} >>'.encode())
+        self._write_font()
+        self._object(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+
+        xref = self.f.tell()
+        size = self.next_object
+        self.f.write(f'xref\n0 {size}\n0000000000 65535 f \n'.encode())
+        for number in range(1, size):
+            offset = self.offsets.get(number)
+            if offset is None:
+                self.f.write(b'0000000000 65535 f \n')
+            else:
+                self.f.write(f'{offset:010d} 00000 n \n'.encode())
+        self.f.write(f'trailer\n<< /Size {size} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode())
+
+def text_to_pdf(source_path: str, target_path: str, font_path: str = PDF_FONT_PATH) -> int:
+    """Render a text file as monospace A4 pages; returns the number of pages."""
+    font = load_font(font_path)
+    if font is None:
+        logger.warning("No monospace TrueType font found, falling back to Courier (Latin-1 only)")
+    encoding = detect_encoding(source_path)
+    with open(source_path, 'r', encoding=encoding, errors='replace') as source, \
+            open(target_path, 'wb') as target:
+        writer = TextPdfWriter(target, font)
+        writer.write_lines(wrap_lines(source, writer.columns))
+        writer.close()
+    return len(writer.pages)
@@ -0,0 +1,59 @@
+"""
+Concurrent update processing that keeps the updates of each user in order.
+"""
+import asyncio
+from typing import Any, Awaitable, Dict, Hashable, Optional
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+CANCEL_TEXT = 'Отмена'
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Process updates of different users concurrently, but one user's updates one at a time.
+
+    Handlers keep per-user state in user_data and PENDING_UPLOADS, so a
+    format choice must not overtake the upload it refers to. The cancel
+    button skips the queue: it has to reach cancel_jobs while the user's
+    conversion is still running.
+    """
+
+    def __init__(self, max_concurrent_updates: int = 256):
+        super().__init__(max_concurrent_updates)
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+        self._queued: Dict[Hashable, int] = {}  # user -> updates holding or waiting for the lock
+
+    @staticmethod
+    def _user_key(update: object) -> Optional[Hashable]:
+        """The user (or chat) whose updates must stay in order; None for updates without one."""
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return ('chat', update.effective_chat.id)
+        return None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self._user_key(update)
+        message = update.effective_message if isinstance(update, Update) else None
+        if key is None or (message is not None and message.text == CANCEL_TEXT):
+            await coroutine
+            return
+
+        # asyncio.Lock пропускает ожидающих в порядке очереди, то есть в порядке апдейтов
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._queued[key] = self._queued.get(key, 0) + 1
+        try:
+            async with lock:
+                await coroutine
+        finally:
+            self._queued[key] -= 1
+            if not self._queued[key]:
+                del self._queued[key]
+                del self._locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
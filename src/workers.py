@@ -0,0 +1,62 @@
+"""
+Process pool for CPU-bound conversion work.
+"""
+import asyncio
+import logging
+import multiprocessing
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from src.config import WORKER_PROCESSES
+
+logger = logging.getLogger(__name__)
+
+# Воркеры не форкаются от процесса с работающим event loop и его потоками
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+_process_pool = None
+
+class WorkerCrashedError(RuntimeError):
+    """A worker process died while running the job (for example killed for lack of memory)."""
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """Get the shared worker process pool, creating it on first use."""
+    global _process_pool
+    if _process_pool is None:
+        logger.info(f"Starting worker pool with {WORKER_PROCESSES} processes ({START_METHOD})")
+        _process_pool = ProcessPoolExecutor(
+            max_workers=WORKER_PROCESSES, mp_context=multiprocessing.get_context(START_METHOD)
+        )
+    return _process_pool
+
+def _discard_pool(pool: ProcessPoolExecutor) -> None:
+    """Drop a broken pool so that the next job starts a new one."""
+    global _process_pool
+    if _process_pool is pool:
+        _process_pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+async def run_in_process(func, *args, **kwargs):
+    """Run a picklable function in the worker pool and await its result.
+
+    If a worker dies, the pool is broken for good: it is replaced and the job
+    is retried once; a second crash raises WorkerCrashedError.
+    """
+    loop = asyncio.get_running_loop()
+    call = partial(func, *args, **kwargs)
+    for attempt in range(2):
+        pool = get_process_pool()
+        try:
+            return await loop.run_in_executor(pool, call)
+        except BrokenProcessPool:
+            _discard_pool(pool)
+            if attempt:
+                raise WorkerCrashedError("Процесс конвертации аварийно завершился (возможно, не хватило памяти)")
+            logger.warning(f"Worker process died, restarting the pool and retrying {getattr(func, '__name__', func)}")
+
+def shutdown_workers() -> None:
+    """Stop the worker pool."""
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
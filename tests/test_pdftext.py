@@ -0,0 +1,40 @@
+import asyncio
+import functools
+import pytest
+
+pytest.importorskip('dotenv')
+pytest.importorskip('PyPDF2')
+
+from src import pdftext
+from src.textpdf import text_to_pdf
+from src.workers import shutdown_workers
+
+@pytest.fixture
+def sample_pdf(tmp_path):
+    source = tmp_path / 'sample.txt'
+    with open(source, 'w', encoding='utf-8') as f:
+        for line in range(7 * 80):
+            f.write(f"line {line} of the sample text\n")
+    target = tmp_path / 'sample.pdf'
+    pages = text_to_pdf(str(source), str(target), font_path=str(tmp_path / 'missing.ttf'))
+    assert pages > 5
+    return target
+
+def test_sharded_text_matches_serial_extraction(sample_pdf, tmp_path, monkeypatch):
+    pages = pdftext.count_pages(str(sample_pdf))
+    serial = tmp_path / 'serial.txt'
+    pdftext.extract_pages(str(sample_pdf), 0, pages, str(serial))
+
+    # Маленькие части, чтобы границ между ними было несколько
+    monkeypatch.setattr(pdftext, 'split_pages', functools.partial(pdftext.split_pages, shard_pages=2))
+    sharded = tmp_path / 'sharded.txt'
+    work_dir = tmp_path / 'work'
+    work_dir.mkdir()
+    try:
+        extracted = asyncio.run(pdftext.pdf_to_text(str(sample_pdf), str(sharded), str(work_dir)))
+    finally:
+        shutdown_workers()
+
+    assert extracted == pages
+    assert sharded.read_bytes() == serial.read_bytes()
+    assert not list(work_dir.iterdir())
@@ -0,0 +1,46 @@
+import os
+import shutil
+import pytest
+from types import SimpleNamespace
+
+pytest.importorskip('dotenv')
+
+from src.spool import SpoolFullError, SpoolManager
+
+def test_concurrent_reservations_share_the_quota(tmp_path):
+    spool = SpoolManager(root=str(tmp_path), quota=100)
+    first = spool.acquire(reserve=80)
+
+    # Первая задача еще ничего не записала, но ее 80 байт уже заняты
+    with pytest.raises(SpoolFullError):
+        spool.acquire(reserve=80)
+
+    spool.release(first)
+    second = spool.acquire(reserve=80)
+    assert os.path.isdir(second)
+    spool.release(second)
+    assert spool.usage() == 0
+
+def test_written_bytes_are_not_counted_twice(tmp_path):
+    spool = SpoolManager(root=str(tmp_path), quota=100)
+    work_dir = spool.acquire(reserve=60)
+    with open(os.path.join(work_dir, 'output'), 'wb') as f:
+        f.write(b'x' * 50)
+    assert spool.usage() == 60
+
+    # Файлы сверх резерва считаются по фактическому размеру
+    with open(os.path.join(work_dir, 'output'), 'ab') as f:
+        f.write(b'x' * 20)
+    assert spool.usage() == 70
+    spool.release(work_dir)
+
+def test_quota_is_capped_at_free_space(tmp_path, monkeypatch):
+    spool = SpoolManager(root=str(tmp_path), quota=1000)
+    monkeypatch.setattr(shutil, 'disk_usage', lambda path: SimpleNamespace(total=1000, used=900, free=100))
+    assert spool.capacity() == 100
+
+    # Квота больше свободного места (например, маленький /dev/shm): упираемся в место
+    with pytest.raises(SpoolFullError):
+        spool.acquire(reserve=150)
+    work_dir = spool.acquire(reserve=80)
+    spool.release(work_dir)
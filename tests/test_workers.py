@@ -0,0 +1,25 @@
+import os
+import asyncio
+import pytest
+
+pytest.importorskip('dotenv')
+
+from src import workers
+
+def crash():
+    os._exit(9)
+
+def double(value):
+    return value * 2
+
+def test_pool_recovers_after_a_worker_dies():
+    async def scenario():
+        with pytest.raises(workers.WorkerCrashedError):
+            await workers.run_in_process(crash)
+        # Сломанный пул заменен, следующие задачи выполняются
+        return await workers.run_in_process(double, 21)
+
+    try:
+        assert asyncio.run(scenario()) == 42
+    finally:
+        workers.shutdown_workers()